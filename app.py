@@ -1,23 +1,44 @@
-from flask import Flask, render_template, render_template_string, jsonify, request
-import imaplib
-import email
-from email.header import decode_header
+from flask import Flask, Blueprint, render_template, render_template_string, jsonify, request, Response, g, has_request_context
+from email.header import decode_header, make_header
+from email.parser import BytesFeedParser
+from email.utils import make_msgid
+from html.parser import HTMLParser
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import time
 import threading
+import asyncio
+import random
 import os
+import base64
+import quopri
+import atexit
+import uuid
+import socket
 import google.generativeai as genai
+from google.api_core.exceptions import ResourceExhausted
+from imapclient import IMAPClient, SEEN
 from dotenv import load_dotenv
-from pymongo import MongoClient
+from bson.objectid import ObjectId
+from pymongo import MongoClient, ASCENDING, DESCENDING, TEXT, ReturnDocument, InsertOne, ReplaceOne, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.write_concern import WriteConcern
 from datetime import datetime, timedelta
 import re
+import json
+import math
+import hashlib
+import zlib
+import functools
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, wait
 from langdetect import detect, LangDetectException
 
 load_dotenv()
 
-app = Flask(__name__)
+bp = Blueprint("main", __name__, cli_group=None)
 
 EMAIL_USER = os.getenv("EMAIL_USER")
 EMAIL_PASS = os.getenv("EMAIL_PASS")
@@ -31,59 +52,1141 @@ DEPARTMENTS = {
     "General Inquiry": os.getenv("GENERAL_EMAIL"),
 }
 
+SENTIMENTS = ["Positive", "Neutral", "Negative", "Very Negative"]
+
+IMAP_HOST = os.getenv("IMAP_HOST", "imap.gmail.com")
+IMAP_MODE = os.getenv("IMAP_MODE", "idle")  # "idle" (push) or "poll"
+IMAP_IDLE_TIMEOUT = int(os.getenv("IMAP_IDLE_TIMEOUT", "600"))  # re-issue IDLE well before the server's 29 minute limit
+IMAP_MAX_BACKOFF = int(os.getenv("IMAP_MAX_BACKOFF", "300"))
+IMAP_FETCH_BATCH = int(os.getenv("IMAP_FETCH_BATCH", "50"))
+IMAP_MAX_PART_BYTES = int(os.getenv("IMAP_MAX_PART_BYTES", str(256 * 1024)))  # bytes read per text part
+IMAP_MAX_TEXT_PARTS = 4  # inline text parts joined into the body
+
+# Charsets that mail clients commonly mislabel, decoded with their superset
+CHARSET_ALIASES = {
+    "us-ascii": "cp1252",
+    "iso-8859-1": "cp1252",
+    "latin1": "cp1252",
+    "gb2312": "gb18030",
+    "ks_c_5601-1987": "cp949",
+}
+POLL_INTERVAL = int(os.getenv("POLL_INTERVAL", "30"))
+POLLER_LEASE_SECONDS = int(os.getenv("POLLER_LEASE_SECONDS", "90"))  # must exceed POLL_INTERVAL; renewed while polling
+POLLING_STATE_REFRESH = 5  # seconds between reads of the persisted polling switch
+# "leader": only the process holding the poller lease runs queue jobs, so the Gemini rate limits, SMTP pool
+# and customer ID budget apply once; "all": every process that started background processing runs them
+QUEUE_WORKERS_ON = os.getenv("QUEUE_WORKERS_ON", "leader")
+
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4"))
+SMTP_NOOP_AFTER = int(os.getenv("SMTP_NOOP_AFTER", "30"))  # seconds idle before a connection is health-checked
+SMTP_MAX_IDLE = int(os.getenv("SMTP_MAX_IDLE", "240"))  # seconds idle before a connection is dropped
+
+# Write-behind persistence: operations per bulk_write, longest wait before a partial batch is flushed,
+# write concern ("0", "1", "majority", ...) and how long a caller waits for its acknowledgement
+BULK_WRITE_BATCH_SIZE = int(os.getenv("BULK_WRITE_BATCH_SIZE", "100"))
+BULK_WRITE_INTERVAL = float(os.getenv("BULK_WRITE_INTERVAL", "0.05"))
+BULK_WRITE_TIMEOUT = float(os.getenv("BULK_WRITE_TIMEOUT", "30"))
+
+# Job queue: worker threads per stage, keyed by the stage the jobs are waiting at
+STAGE_WORKERS = {
+    "fetched": int(os.getenv("ANALYZE_CONCURRENCY", "4")),
+    "analyzed": int(os.getenv("SEND_CONCURRENCY", "2")),
+    "forwarded": int(os.getenv("SEND_CONCURRENCY", "2")),
+    "replied": int(os.getenv("STORE_CONCURRENCY", "4")),
+}
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))  # renewed every third of this while a stage runs
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "6"))
+JOB_RETRY_BASE_DELAY = int(os.getenv("JOB_RETRY_BASE_DELAY", "30"))
+JOB_RETRY_MAX_DELAY = int(os.getenv("JOB_RETRY_MAX_DELAY", "3600"))
+JOB_RETENTION_DAYS = int(os.getenv("JOB_RETENTION_DAYS", "7"))  # how long finished jobs are kept for deduplication
+QUEUE_IDLE_SLEEP = float(os.getenv("QUEUE_IDLE_SLEEP", "1"))
+
+# "rollups" reads the pre-aggregated hourly/daily metrics, "live" aggregates the emails collection
+ANALYTICS_SOURCE = os.getenv("ANALYTICS_SOURCE", "rollups")
+
+# Dashboard paging
+DASHBOARD_PAGE_SIZE = int(os.getenv("DASHBOARD_PAGE_SIZE", "25"))
+EMAIL_PREVIEW_LENGTH = 200
+
+# Search: "text" uses the MongoDB text index (falling back to "local" if it fails), "local" an in-process index
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "text")
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "1000"))
+SEARCH_FIELD_WEIGHTS = {"subject": 10, "customer_id": 10, "sender": 5, "summary": 3, "search_terms": 1}
+SEARCH_TERMS_LIMIT = int(os.getenv("SEARCH_TERMS_LIMIT", "300"))  # distinct body words kept on each email for search
+
+# Cold storage: bodies and response texts at least COLD_TEXT_MIN_CHARS long are kept zlib-compressed in a
+# separate collection; emails and responses older than ARCHIVE_AFTER_DAYS can be moved to archive collections
+COLD_TEXT_MIN_CHARS = int(os.getenv("COLD_TEXT_MIN_CHARS", "256"))
+COLD_COMPRESSION_LEVEL = 6
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = 500
+
+# Gemini gateway: rate limits, adaptive concurrency bounds and retries on quota errors
+LLM_MAX_RPM = int(os.getenv("LLM_MAX_RPM", "300"))
+LLM_MAX_TPM = int(os.getenv("LLM_MAX_TPM", "1000000"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+LLM_TARGET_LATENCY = float(os.getenv("LLM_TARGET_LATENCY", "10"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))
+
+# Local fast-path classifier; Gemini is only asked to classify below this confidence
+LOCAL_CLASSIFIER_PATH = os.getenv("LOCAL_CLASSIFIER_PATH", "classifier_model.json")
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", "0.9"))
+LOCAL_CLASSIFIER_TRAINING_LIMIT = int(os.getenv("LOCAL_CLASSIFIER_TRAINING_LIMIT", "50000"))
+LOCAL_CLASSIFIER_MANUAL_WEIGHT = int(os.getenv("LOCAL_CLASSIFIER_MANUAL_WEIGHT", "3"))
+LOCAL_CLASSIFIER_MIN_COVERAGE = float(os.getenv("LOCAL_CLASSIFIER_MIN_COVERAGE", "0.6"))  # share of words the model knows
+LOCAL_CLASSIFIER_HOLDOUT = 0.2  # share of the samples held out to calibrate confidences
+LOCAL_CLASSIFIER_CALIBRATION_BINS = 10
+LOCAL_CLASSIFIER_MIN_BIN_SAMPLES = 20
+
+# LLM result cache
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_PERSIST = os.getenv("LLM_CACHE_PERSIST", "false").lower() == "true"
+
+# Bump a prompt's version whenever its wording changes so stale cached results are ignored
+PROMPT_VERSIONS = {
+    "analysis": 1,
+    "auto_response": 1,
+}
+
+# Near-duplicate clustering: SimHash distance, activity window and forward notice thresholds
+DUPLICATE_DETECTION = os.getenv("DUPLICATE_DETECTION", "true").lower() == "true"
+DUPLICATE_MAX_DISTANCE = int(os.getenv("DUPLICATE_MAX_DISTANCE", "10"))  # differing bits out of 64
+DUPLICATE_SHINGLE_SIZE = 2
+DUPLICATE_MIN_TOKENS = int(os.getenv("DUPLICATE_MIN_TOKENS", "20"))
+DUPLICATE_WINDOW_HOURS = int(os.getenv("DUPLICATE_WINDOW_HOURS", "24"))
+DUPLICATE_NOTICE_THRESHOLDS = [int(n) for n in os.getenv("DUPLICATE_NOTICE_THRESHOLDS", "5,25,100,500").split(",")]
+
+# Customer IDs: accepted format, and the hourly budget of model calls for IDs the patterns miss
+CUSTOMER_ID_FORMAT = os.getenv("CUSTOMER_ID_FORMAT", r"(?=[A-Z]*[0-9])[A-Z0-9]{4,15}")
+CUSTOMER_ID_LLM_BUDGET = int(os.getenv("CUSTOMER_ID_LLM_BUDGET", "60"))
+
+# Token budgets for the email text placed in each prompt; longer bodies keep their head and tail
+PROMPT_TOKEN_BUDGETS = {
+    "analysis": int(os.getenv("PROMPT_TOKENS_ANALYSIS", "3000")),
+    "auto_response": int(os.getenv("PROMPT_TOKENS_AUTO_RESPONSE", "2000")),
+}
+PROMPT_HEAD_RATIO = float(os.getenv("PROMPT_HEAD_RATIO", "0.7"))
+
 # Define priority keywords
 URGENT_KEYWORDS = [
     "urgent", "asap", "immediately", "emergency", "critical", 
     "important", "deadline", "quick", "expedite", "rush"
 ]
 
-client = MongoClient(MONGODB_URI)
-db = client.emails_db
-emails_collection = db.emails
-responses_collection = db.responses
+class Metric:
+    """A labelled metric family rendered in the Prometheus text format."""
 
-genai.configure(api_key=GEMINI_API_KEY)
-model = genai.GenerativeModel("gemini-1.5-flash")
+    kind = "untyped"
 
-polling_active = False
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
 
-def classify_email(body):
-    prompt = f"""
-    Classify the issue below into one of these categories:
-    - Technical
-    - Billing
-    - Complaint
-    - General Inquiry
-
-    Message: "{body}"
-    Only return the category.
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in pairs)
+        return "{" + ",".join(f'{label}="{value}"' for (label, _), value in zip(pairs, escaped)) + "}"
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, self._format_labels(key), value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {float(value)!r}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def replace(self, values):
+        """Replace every series at once from a {labels tuple: value} mapping."""
+        with self._lock:
+            self._values = dict(values)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, series in self._values.items():
+                for bound, count in zip(self.buckets, series["buckets"]):
+                    samples.append((f"{self.name}_bucket", self._format_labels(key, [("le", f"{bound:g}")]), count))
+                samples.append((f"{self.name}_bucket", self._format_labels(key, [("le", "+Inf")]), series["count"]))
+                samples.append((f"{self.name}_sum", self._format_labels(key), series["sum"]))
+                samples.append((f"{self.name}_count", self._format_labels(key), series["count"]))
+        return samples
+
+class MetricsRegistry:
+    """In-process registry of the metrics exposed at /metrics.
+
+    Values are per process; with several gunicorn workers each worker reports
+    its own series and the scraper sees whichever worker answers.
     """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), **kwargs):
+        return self.register(Histogram(name, documentation, labelnames, **kwargs))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self._metrics) + "\n"
+
+metrics = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = metrics.histogram("http_request_duration_seconds", "Dashboard and API request latency.", ["route", "method"])
+MONGO_COMMAND_SECONDS = metrics.histogram("mongodb_command_duration_seconds", "MongoDB command latency by route ('background' outside requests).", ["route", "command"])
+MONGO_COMMAND_ERRORS = metrics.counter("mongodb_command_errors_total", "Failed MongoDB commands.", ["route", "command"])
+IMAP_FETCH_SECONDS = metrics.histogram("imap_fetch_duration_seconds", "Time to fetch one batch of messages from the mailbox.")
+EMAILS_FETCHED = metrics.counter("imap_messages_fetched_total", "Messages fetched from the mailbox and queued.")
+LLM_REQUEST_SECONDS = metrics.histogram("llm_request_duration_seconds", "Gemini call latency per analysis function.", ["function"])
+LLM_EVENTS = metrics.counter("llm_events_total", "Gemini calls, errors, rate-limit retries and coalesced requests per function.", ["function", "event"])
+LLM_TOKENS = metrics.counter("llm_tokens_total", "Gemini prompt and output tokens per function.", ["function", "kind"])
+LLM_CONCURRENCY_LIMIT = metrics.gauge("llm_concurrency_limit", "Current adaptive Gemini concurrency limit.")
+LLM_CACHE_HIT_RATIO = metrics.gauge("llm_cache_hit_ratio", "Share of LLM cache lookups served from the cache.")
+LLM_CACHE_LOOKUPS = metrics.gauge("llm_cache_lookups", "LLM cache lookups since start by result.", ["result"])
+BULK_WRITE_BATCH = metrics.histogram("mongodb_bulk_write_batch_size", "Operations per write-behind bulk_write.", ["collection"],
+                                     buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+SMTP_SEND_SECONDS = metrics.histogram("smtp_send_duration_seconds", "Time to send one message through the SMTP pool.")
+SMTP_SEND_ERRORS = metrics.counter("smtp_send_errors_total", "Messages the SMTP pool failed to send.")
+QUEUE_STAGE_SECONDS = metrics.histogram("queue_stage_duration_seconds", "Time spent in each pipeline stage handler.", ["stage"])
+QUEUE_JOBS_PROCESSED = metrics.counter("queue_jobs_processed_total", "Jobs that finished or failed a pipeline stage.", ["stage", "outcome"])
+QUEUE_DEPTH = metrics.gauge("queue_jobs", "Jobs in the queue by stage and status.", ["stage", "status"])
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Times every MongoDB command and attributes it to the Flask route that issued it."""
+
+    @staticmethod
+    def _route():
+        # Listeners run on the thread that issued the command, so the request context is visible
+        if has_request_context() and request.url_rule is not None:
+            return request.url_rule.rule
+        return "background"
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, route=self._route(), command=event.command_name)
+
+    def failed(self, event):
+        route = self._route()
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, route=route, command=event.command_name)
+        MONGO_COMMAND_ERRORS.inc(route=route, command=event.command_name)
+
+# Spans of the job being processed on this thread; None when no trace is being collected
+trace_context = threading.local()
+
+@contextmanager
+def collect_spans(spans):
+    """Collect the spans recorded on this thread into a list."""
+    trace_context.spans, trace_context.depth = spans, 0
+    try:
+        yield spans
+    finally:
+        trace_context.spans = None
+
+@contextmanager
+def trace_span(name):
+    """Time a block as a span of the trace collected on this thread, if any."""
+    spans = getattr(trace_context, "spans", None)
+    if spans is None:
+        yield
+        return
+    
+    depth = trace_context.depth
+    span = {"name": name, "start": datetime.now(), "depth": depth}
+    started = time.monotonic()
+    trace_context.depth = depth + 1
     try:
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        yield
     except Exception as e:
-        print("Classification Error:", e)
-        return "Unclassified"
+        span["error"] = str(e)[:200]
+        raise
+    finally:
+        trace_context.depth = depth
+        span["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+        spans.append(span)
 
-def analyze_sentiment(body):
-    """Analyze the sentiment of the email body."""
-    prompt = f"""
-    Analyze the sentiment of this message and classify it as one of:
-    - Positive
-    - Neutral
-    - Negative
-    - Very Negative
+def traced(name):
+    """Record every call of the decorated function as a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class LazyProxy:
+    """Stand-in for a client or service that is only built on first use.
+
+    Importing the app therefore opens no connections and starts no threads.
+    The object is rebuilt in a forked child (such as a gunicorn worker), so
+    connections and background threads are never shared between processes.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._instance = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._instance = self._factory()
+                    self._pid = os.getpid()
+        return self._instance
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __getitem__(self, key):
+        return self._resolve()[key]
+
+def create_model():
+    genai.configure(api_key=GEMINI_API_KEY)
+    return genai.GenerativeModel("gemini-1.5-flash")
+
+client = LazyProxy(lambda: MongoClient(MONGODB_URI, event_listeners=[MongoCommandMetrics()]))
+db = LazyProxy(lambda: client.emails_db)
+emails_collection = LazyProxy(lambda: db.emails)
+responses_collection = LazyProxy(lambda: db.responses)
+metrics_collection = LazyProxy(lambda: db.metrics_rollups)
+jobs_collection = LazyProxy(lambda: db.jobs)
+settings_collection = LazyProxy(lambda: db.settings)
+locks_collection = LazyProxy(lambda: db.locks)
+conversations_collection = LazyProxy(lambda: db.conversations)
+clusters_collection = LazyProxy(lambda: db.clusters)
+blobs_collection = LazyProxy(lambda: db.email_bodies)
+emails_archive_collection = LazyProxy(lambda: db.emails_archive)
+responses_archive_collection = LazyProxy(lambda: db.responses_archive)
+
+model = LazyProxy(create_model)
+
+# Indexes matched to the query shapes used by the dashboard, analytics and details pages
+INDEX_SPECS = [
+    ("emails", [("category", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)], {"name": "category_timestamp_id"}),
+    ("emails", [("timestamp", DESCENDING)], {"name": "timestamp"}),
+    ("emails", [("category", ASCENDING), ("status", ASCENDING), ("timestamp", DESCENDING)], {"name": "category_status_timestamp"}),
+    ("emails", [("status", ASCENDING), ("timestamp", DESCENDING)], {"name": "status_timestamp"}),
+    ("emails", [("priority", ASCENDING), ("timestamp", DESCENDING)], {"name": "priority_timestamp"}),
+    ("emails", [("sender", ASCENDING), ("subject", ASCENDING)], {"name": "sender_subject"}),
+    ("emails", [(field, TEXT) for field in SEARCH_FIELD_WEIGHTS], {
+        "name": "email_text_search",
+        "weights": SEARCH_FIELD_WEIGHTS,
+        # Emails carry a detected "language" code that MongoDB would otherwise try to use for stemming
+        "language_override": "search_language",
+    }),
+    ("emails", [("thread_key", ASCENDING), ("timestamp", ASCENDING)], {"name": "thread_key_timestamp"}),
+    ("responses", [("recipient", ASCENDING), ("timestamp", ASCENDING)], {"name": "recipient_timestamp"}),
+    ("responses", [("email_id", ASCENDING), ("timestamp", ASCENDING)], {"name": "email_id_timestamp"}),
+    ("conversations", [("message_ids", ASCENDING)], {"name": "message_ids"}),
+    ("clusters", [("last_seen", DESCENDING), ("count", DESCENDING)], {"name": "last_seen_count"}),
+    ("emails_archive", [("timestamp", DESCENDING)], {"name": "timestamp_desc"}),
+    ("responses_archive", [("email_id", ASCENDING), ("timestamp", ASCENDING)], {"name": "email_id_timestamp"}),
+    ("jobs", [("stage", ASCENDING), ("status", ASCENDING), ("next_attempt_at", ASCENDING)], {"name": "stage_status_next_attempt"}),
+    # Finished jobs only keep their UID key and routing fields, and expire after the retention period
+    ("jobs", [("completed_at", ASCENDING)], {"name": "completed_at_ttl", "expireAfterSeconds": JOB_RETENTION_DAYS * 86400}),
+    ("metrics_rollups", [("granularity", ASCENDING), ("start", ASCENDING)], {"name": "granularity_start"}),
+    ("llm_cache", [("expires_at", ASCENDING)], {"name": "expires_at_ttl", "expireAfterSeconds": 0}),
+]
+
+# Last known value of the polling switch persisted in the settings collection
+polling_state = {"active": False, "checked_at": float("-inf")}
+poller_lease_state = {"held_until": float("-inf")}  # monotonic time this process's lease runs out
+
+# UID tracking for incremental fetches; UIDs are only comparable within one UIDVALIDITY
+mailbox_state = {"uidvalidity": None, "uidnext": None, "retry_uids": set()}
+
+class LLMCache:
+    """Cache of Gemini results keyed by prompt version and normalized content.
+
+    An in-process LRU tier is always used; when a MongoDB collection is given,
+    results are also persisted there so they survive restarts and are shared
+    between processes. Entries expire after the TTL.
+    """
+
+    def __init__(self, max_size, ttl, collection=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.collection = collection
+        self._entries = OrderedDict()  # key -> (value, expires_at)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(kind, *parts):
+        """Build a cache key from the prompt kind and whitespace-normalized inputs."""
+        normalized = "\x1f".join(" ".join(str(part or "").split()) for part in parts)
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{kind}:v{PROMPT_VERSIONS[kind]}:{digest}"
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry:
+                del self._entries[key]
+        
+        if self.collection is not None:
+            try:
+                doc = self.collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now()}})
+                if doc:
+                    self._remember(key, doc["value"], doc["expires_at"].timestamp())
+                    with self._lock:
+                        self.hits += 1
+                        self.persistent_hits += 1
+                    return doc["value"]
+            except Exception as e:
+                print("LLM Cache Read Error:", e)
+        
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self.collection is not None:
+            try:
+                self.collection.replace_one(
+                    {"_id": key},
+                    {"value": value, "expires_at": datetime.fromtimestamp(expires_at)},
+                    upsert=True
+                )
+            except Exception as e:
+                print("LLM Cache Write Error:", e)
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "persistent_hits": self.persistent_hits,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0,
+            }
+
+llm_cache = LLMCache(LLM_CACHE_SIZE, LLM_CACHE_TTL, LazyProxy(lambda: db.llm_cache) if LLM_CACHE_PERSIST else None)
+
+class TokenBucket:
+    """Token bucket that refills continuously up to a per-minute capacity."""
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    async def acquire(self, amount=1):
+        # Requests larger than the whole bucket wait for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+class LLMGateway:
+    """Async front end for the Gemini model shared by every analysis function.
+
+    Runs its own event loop on a background thread and calls
+    generate_content_async. Requests pass through requests-per-minute and
+    tokens-per-minute token buckets and an adaptive concurrency limit that halves
+    on quota (429) errors and grows back while latency stays under target.
+    Quota errors are retried with backoff instead of surfacing as fallback
+    labels, and identical prompts already in flight share a single call.
+    """
+
+    def __init__(self, model, rpm, tpm, max_concurrency, target_latency, max_retries):
+        self.model = model
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.limit = float(max_concurrency)
+        self.active = 0
+        self.metrics = {}
+        self._inflight = {}
+        self._requests = TokenBucket(rpm)
+        self._tokens = TokenBucket(tpm)
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, daemon=True, name="llm-gateway").start()
+        self._condition = asyncio.run_coroutine_threadsafe(self._create_condition(), self._loop).result()
+
+    @staticmethod
+    async def _create_condition():
+        return asyncio.Condition()
+
+    def generate(self, prompt, name, generation_config=None, timeout=300):
+        """Run a prompt from a worker thread and return the response text."""
+        with trace_span(f"gemini:{name}"):
+            future = asyncio.run_coroutine_threadsafe(
+                self.generate_async(prompt, name, generation_config), self._loop
+            )
+            return future.result(timeout)
+
+    async def generate_async(self, prompt, name, generation_config=None):
+        key = (prompt, json.dumps(generation_config, sort_keys=True))
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._loop.create_task(self._generate(prompt, name, generation_config))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self._record(name, coalesced=1)
+        return await asyncio.shield(task)
+
+    async def _generate(self, prompt, name, generation_config):
+        # Rough estimate (about 4 characters per token) plus room for the answer
+        estimated_tokens = len(prompt) // 4 + 512
+        
+        for attempt in range(self.max_retries + 1):
+            await self._requests.acquire()
+            await self._tokens.acquire(estimated_tokens)
+            
+            async with self._condition:
+                await self._condition.wait_for(lambda: self.active < int(self.limit))
+                self.active += 1
+            
+            started = time.monotonic()
+            quota_error = None
+            try:
+                response = await self.model.generate_content_async(prompt, generation_config=generation_config)
+                text = response.text
+            except ResourceExhausted as e:
+                quota_error = e
+            except Exception:
+                self._record(name, errors=1, latency=time.monotonic() - started)
+                raise
+            finally:
+                async with self._condition:
+                    self.active -= 1
+                    self._condition.notify_all()
+            
+            if quota_error is not None:
+                self._record(name, rate_limited=1)
+                self.limit = max(1.0, self.limit / 2)
+                if attempt == self.max_retries:
+                    self._record(name, errors=1)
+                    raise quota_error
+                delay = min(2 ** attempt, 30) + random.random()
+                print(f"Gemini quota exceeded in {name}, retrying in {delay:.1f}s: {str(quota_error)}")
+                await asyncio.sleep(delay)
+                continue
+            
+            latency = time.monotonic() - started
+            if latency < self.target_latency:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            usage = getattr(response, "usage_metadata", None)
+            self._record(
+                name,
+                calls=1,
+                latency=latency,
+                prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+                output_tokens=getattr(usage, "candidates_token_count", 0) or 0,
+            )
+            return text
+
+    def _record(self, name, latency=None, **counters):
+        for counter, value in counters.items():
+            if counter in ("prompt_tokens", "output_tokens"):
+                LLM_TOKENS.inc(value, function=name, kind=counter.removesuffix("_tokens"))
+            else:
+                LLM_EVENTS.inc(value, function=name, event=counter)
+        if latency is not None:
+            LLM_REQUEST_SECONDS.observe(latency, function=name)
+        LLM_CONCURRENCY_LIMIT.set(int(self.limit))
+        
+        metrics = self.metrics.setdefault(name, {
+            "calls": 0, "errors": 0, "rate_limited": 0, "coalesced": 0,
+            "prompt_tokens": 0, "output_tokens": 0,
+            "latency_total": 0.0, "latency_max": 0.0,
+        })
+        for counter, value in counters.items():
+            metrics[counter] += value
+        if latency is not None:
+            metrics["latency_total"] += latency
+            metrics["latency_max"] = max(metrics["latency_max"], latency)
+
+    def stats(self):
+        functions = {}
+        for name, metrics in list(self.metrics.items()):
+            attempts = metrics["calls"] + metrics["errors"]
+            functions[name] = {
+                **metrics,
+                "avg_latency": metrics["latency_total"] / attempts if attempts else 0,
+            }
+        return {
+            "concurrency_limit": int(self.limit),
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "functions": functions,
+        }
+
+llm_gateway = LazyProxy(lambda: LLMGateway(
+    model, LLM_MAX_RPM, LLM_MAX_TPM, LLM_MAX_CONCURRENCY, LLM_TARGET_LATENCY, LLM_MAX_RETRIES
+))
+
+class LocalClassifier:
+    """Multinomial naive Bayes text classifier used as a fast path before Gemini.
+
+    Models for category and sentiment are trained offline from labelled emails
+    (see train_local_classifier) and saved as one JSON file. The file is checked
+    for changes periodically, so a retrained model is picked up without a restart.
+
+    Raw naive Bayes posteriors are overconfident, so the reported confidence is
+    the accuracy measured on held-out samples for emails with a similar raw
+    score. Text made mostly of words the model has never seen gets no
+    confidence at all.
+    """
+
+    def __init__(self, path, check_interval=30):
+        self.path = path
+        self.check_interval = check_interval
+        self.models = {}
+        self.vocabularies = {}
+        self._mtime = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(text):
+        return re.findall(r"[a-z0-9']{2,}", (text or "").lower())
+
+    @classmethod
+    def train_model(cls, samples, max_vocabulary=20000):
+        """Fit a model from (text, label, weight) samples, calibrated on a held-out share of them.
+
+        With too few samples to hold any out the model is saved uncalibrated and
+        never reports a confident label.
+        """
+        samples = list(samples)
+        random.Random(0).shuffle(samples)
+        holdout_size = int(len(samples) * LOCAL_CLASSIFIER_HOLDOUT)
+        model = cls.fit(samples[holdout_size:], max_vocabulary)
+        model["calibration"] = cls.calibrate(model, samples[:holdout_size])
+        return model
+
+    @classmethod
+    def fit(cls, samples, max_vocabulary):
+        label_weights, token_counts, vocabulary = {}, {}, {}
+        for text, label, weight in samples:
+            label_weights[label] = label_weights.get(label, 0) + weight
+            counts = token_counts.setdefault(label, {})
+            for token in cls.tokenize(text):
+                counts[token] = counts.get(token, 0) + weight
+                vocabulary[token] = vocabulary.get(token, 0) + weight
+        
+        vocabulary = set(sorted(vocabulary, key=vocabulary.get, reverse=True)[:max_vocabulary])
+        total_weight = sum(label_weights.values())
+        model = {"labels": {}}
+        for label, counts in token_counts.items():
+            # Laplace smoothing over the retained vocabulary
+            kept = {token: count for token, count in counts.items() if token in vocabulary}
+            denominator = sum(kept.values()) + len(vocabulary)
+            model["labels"][label] = {
+                "prior": math.log(label_weights[label] / total_weight),
+                "unknown": math.log(1 / denominator),
+                "tokens": {token: math.log((count + 1) / denominator) for token, count in kept.items()},
+            }
+        return model
+
+    @staticmethod
+    def model_vocabulary(model):
+        return set().union(*(params["tokens"] for params in model["labels"].values()))
+
+    @staticmethod
+    def raw_prediction(model, tokens, vocabulary):
+        """Best label and its length-normalized naive Bayes posterior, or (None, 0) for unfamiliar text."""
+        if not tokens or sum(token in vocabulary for token in tokens) < LOCAL_CLASSIFIER_MIN_COVERAGE * len(tokens):
+            return None, 0
+        
+        scores = {}
+        for label, params in model["labels"].items():
+            token_scores = params["tokens"]
+            # Averaging per token keeps long emails from driving the posterior to 1
+            likelihood = sum(token_scores.get(token, params["unknown"]) for token in tokens) / len(tokens)
+            scores[label] = params["prior"] + likelihood
+        
+        best = max(scores, key=scores.get)
+        # Softmax over the log scores gives the posterior of the best label
+        return best, 1 / sum(math.exp(score - scores[best]) for score in scores.values())
+
+    @classmethod
+    def calibrate(cls, model, holdout):
+        """Map raw posterior bins to the accuracy observed on held-out samples.
+
+        Bins with too few samples take the value of the bin below, and no bin is
+        allowed above a higher one, so sparse data errs towards calling Gemini.
+        """
+        vocabulary = cls.model_vocabulary(model)
+        bins = [[0, 0] for _ in range(LOCAL_CLASSIFIER_CALIBRATION_BINS)]  # [correct, total]
+        for text, label, _ in holdout:
+            predicted, raw = cls.raw_prediction(model, cls.tokenize(text), vocabulary)
+            if predicted is not None:
+                counts = bins[min(int(raw * len(bins)), len(bins) - 1)]
+                counts[0] += predicted == label
+                counts[1] += 1
+        
+        table, accuracy = [], 0.0
+        for correct, total in bins:
+            if total >= LOCAL_CLASSIFIER_MIN_BIN_SAMPLES:
+                accuracy = correct / total
+            table.append(accuracy)
+        for index in range(len(table) - 2, -1, -1):
+            table[index] = min(table[index], table[index + 1])
+        return table
+
+    def reload_if_changed(self):
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path) as f:
+                models = json.load(f)["models"]
+            vocabularies = {task: self.model_vocabulary(model) for task, model in models.items()}
+            with self._lock:
+                self.models, self.vocabularies, self._mtime = models, vocabularies, mtime
+            print(f"Loaded local classifier from {self.path}")
+        except Exception as e:
+            print("Local Classifier Load Error:", e)
+
+    def predict(self, task, text):
+        """Return (label, calibrated confidence) for a task, or (None, 0) when no model is loaded."""
+        self.reload_if_changed()
+        with self._lock:
+            model, vocabulary = self.models.get(task), self.vocabularies.get(task)
+        if not model:
+            return None, 0
+        
+        best, raw = self.raw_prediction(model, self.tokenize(text), vocabulary)
+        if best is None:
+            return None, 0
+        # Models saved before calibration existed are never trusted
+        calibration = model.get("calibration") or [0.0]
+        return best, calibration[min(int(raw * len(calibration)), len(calibration) - 1)]
+
+    def confident_label(self, task, text):
+        """Return the predicted label if it clears the confidence threshold, else None."""
+        label, confidence = self.predict(task, text)
+        return label if label and confidence >= LOCAL_CLASSIFIER_THRESHOLD else None
+
+local_classifier = LocalClassifier(LOCAL_CLASSIFIER_PATH)
+
+def train_local_classifier(limit=LOCAL_CLASSIFIER_TRAINING_LIMIT):
+    """Train the category and sentiment models from stored emails and save them.
+
+    Only labels that came from Gemini or from a person are used; labels the local
+    classifier or a duplicate cluster assigned would feed the model its own
+    output. Categories corrected through /reassign-category are weighted more
+    heavily. The file is replaced atomically so running processes can hot-reload it.
+    """
+    category_samples, sentiment_samples = [], []
+    emails = emails_collection.find(
+        # Emails stored before classified_by existed were all labelled by Gemini
+        {"$or": [{"category_source": "manual"}, {"classified_by": {"$in": ["gemini", None]}}]},
+        {"subject": 1, "body": 1, "normalized_body": 1, "cold_fields": 1, "category": 1, "category_source": 1,
+         "classified_by": 1, "sentiment": 1}
+    ).sort("timestamp", DESCENDING).limit(limit).batch_size(500)
     
-    Message: "{body}"
+    for email_doc in hydrated_batches(emails, 500):
+        body = email_doc.get('normalized_body') or normalize_body(email_doc.get('body', ''))
+        text = f"{email_doc.get('subject', '')} {body}"
+        category = email_doc.get('category')
+        labelled_by_gemini = email_doc.get('classified_by') in (None, "gemini")
+        if category in DEPARTMENTS:
+            weight = LOCAL_CLASSIFIER_MANUAL_WEIGHT if email_doc.get('category_source') == "manual" else 1
+            category_samples.append((text, category, weight))
+        if labelled_by_gemini and email_doc.get('sentiment') in SENTIMENTS:
+            sentiment_samples.append((text, email_doc['sentiment'], 1))
     
-    Only return the sentiment category.
+    models = {}
+    if category_samples:
+        models["category"] = LocalClassifier.train_model(category_samples)
+    if sentiment_samples:
+        models["sentiment"] = LocalClassifier.train_model(sentiment_samples)
+    
+    temp_path = f"{LOCAL_CLASSIFIER_PATH}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump({"trained_at": datetime.now().isoformat(), "models": models}, f)
+    os.replace(temp_path, LOCAL_CLASSIFIER_PATH)
+    return len(category_samples), len(sentiment_samples)
+
+@bp.cli.command("train-classifier")
+def train_classifier_command():
+    """Retrain the local category/sentiment classifier from labelled emails."""
+    categories, sentiments = train_local_classifier()
+    print(f"Trained on {categories} category and {sentiments} sentiment label(s); saved to {LOCAL_CLASSIFIER_PATH}")
+
+class SMTPConnectionPool:
+    """A bounded pool of authenticated SMTP connections shared by every send path.
+
+    Connections are reused across messages so STARTTLS and login happen once per
+    connection rather than once per email. Idle connections are NOOP-checked
+    before reuse, kept alive by a background thread and replaced when stale.
     """
-    try:
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        print("Sentiment Analysis Error:", e)
-        return "Neutral"
+
+    def __init__(self, host, port, size, noop_after, max_idle):
+        self.host = host
+        self.port = port
+        self.noop_after = noop_after
+        self.max_idle = max_idle
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = []  # (connection, last_used) pairs, most recently used last
+        self._lock = threading.Lock()
+        threading.Thread(target=self._keepalive, daemon=True).start()
+        atexit.register(self.close)
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=30)
+        server.starttls()
+        server.login(EMAIL_USER, EMAIL_PASS)
+        return server
+
+    @staticmethod
+    def _is_alive(server):
+        try:
+            return server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close(server):
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    server, last_used = self._idle.pop()
+                
+                idle_for = time.monotonic() - last_used
+                if idle_for < self.noop_after or (idle_for < self.max_idle and self._is_alive(server)):
+                    return server
+                self._close(server)
+            return self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, server, healthy=True):
+        if healthy:
+            with self._lock:
+                self._idle.append((server, time.monotonic()))
+        else:
+            self._close(server)
+        self._slots.release()
+
+    def _keepalive(self):
+        while True:
+            time.sleep(self.noop_after)
+            with self._lock:
+                idle, self._idle = self._idle, []
+            
+            kept = []
+            for server, last_used in idle:
+                if time.monotonic() - last_used < self.max_idle and self._is_alive(server):
+                    kept.append((server, last_used))
+                else:
+                    self._close(server)
+            
+            with self._lock:
+                self._idle = kept + self._idle
+
+    @traced("smtp_send")
+    def send_message(self, msg):
+        """Send a message on a pooled connection, reconnecting once if it dropped."""
+        for attempt in range(2):
+            server = self._acquire()
+            started = time.monotonic()
+            try:
+                server.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                self._release(server, healthy=False)
+                if attempt:
+                    SMTP_SEND_ERRORS.inc()
+                    raise
+                print(f"SMTP connection lost, reconnecting: {str(e)}")
+                continue
+            except Exception:
+                self._release(server, healthy=False)
+                SMTP_SEND_ERRORS.inc()
+                raise
+            SMTP_SEND_SECONDS.observe(time.monotonic() - started)
+            self._release(server)
+            return
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
+
+smtp_pool = LazyProxy(lambda: SMTPConnectionPool(SMTP_HOST, SMTP_PORT, SMTP_POOL_SIZE, SMTP_NOOP_AFTER, SMTP_MAX_IDLE))
+
+class BulkWriter:
+    """Write-behind batching of inserts and updates into one bulk_write per collection.
+
+    Each queued operation gets a Future. A background thread flushes a collection's
+    queue once it holds BULK_WRITE_BATCH_SIZE operations or its oldest operation has
+    waited BULK_WRITE_INTERVAL seconds, so concurrent queue workers and dashboard
+    requests share round trips. Batches are unordered: a failed document only fails
+    its own future. Pending operations are flushed when the process exits.
+    """
+
+    def __init__(self, batch_size, interval, write_concern):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.write_concern = write_concern
+        self._pending = {}  # collection name -> [(operation, future)]
+        self._oldest = {}  # collection name -> monotonic time the first pending operation was queued
+        self._cond = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._run, daemon=True, name="bulk-writer").start()
+        atexit.register(self.close)
+
+    def submit(self, collection, operation):
+        """Queue an InsertOne/UpdateOne for a collection and return its Future."""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("bulk writer is closed")
+            pending = self._pending.setdefault(collection.name, [])
+            if not pending:
+                self._oldest[collection.name] = time.monotonic()
+            pending.append((operation, future))
+            # The first operation starts the flush timer; a full batch is flushed right away
+            if len(pending) == 1 or len(pending) >= self.batch_size:
+                self._cond.notify()
+        return future
+
+    def write(self, collection, operations, timeout=None):
+        """Queue several operations and wait until all of them are acknowledged."""
+        futures = [self.submit(collection, operation) for operation in operations]
+        for future in futures:
+            future.result(timeout)
+
+    def _take_ready(self, force=False):
+        now = time.monotonic()
+        ready = []
+        for name, pending in list(self._pending.items()):
+            if force or len(pending) >= self.batch_size or now - self._oldest[name] >= self.interval:
+                ready.append((name, pending[:self.batch_size]))
+                self._pending[name] = pending[self.batch_size:]
+                self._oldest[name] = now
+                if not self._pending[name]:
+                    del self._pending[name], self._oldest[name]
+        return ready
+
+    def _run(self):
+        while True:
+            with self._cond:
+                ready = self._take_ready()
+                while not ready and not self._closed:
+                    waits = [self.interval - (time.monotonic() - oldest) for oldest in self._oldest.values()]
+                    self._cond.wait(max(min(waits), 0) if waits else None)
+                    ready = self._take_ready()
+                if not ready and self._closed:
+                    return
+            for name, batch in ready:
+                self._flush(name, batch)
+
+    def _flush(self, name, batch):
+        BULK_WRITE_BATCH.observe(len(batch), collection=name)
+        write_errors, concern_error = {}, None
+        try:
+            collection = db[name].with_options(write_concern=self.write_concern)
+            collection.bulk_write([operation for operation, _ in batch], ordered=False)
+        except BulkWriteError as e:
+            write_errors = {error["index"]: error for error in e.details.get("writeErrors", [])}
+            if e.details.get("writeConcernErrors"):
+                concern_error = e.details["writeConcernErrors"][0]
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        
+        for index, (_, future) in enumerate(batch):
+            error = write_errors.get(index) or concern_error
+            if error is None:
+                future.set_result(True)
+            elif error.get("code") == 11000:
+                future.set_exception(DuplicateKeyError(error.get("errmsg"), 11000, error))
+            else:
+                future.set_exception(OperationFailure(error.get("errmsg"), error.get("code"), error))
+
+    def close(self):
+        """Flush everything still pending and stop accepting operations."""
+        with self._cond:
+            self._closed = True
+            ready = self._take_ready(force=True)
+            while self._pending:
+                ready += self._take_ready(force=True)
+            self._cond.notify()
+        for name, batch in ready:
+            self._flush(name, batch)
+
+def write_concern_from_env():
+    w = os.getenv("BULK_WRITE_CONCERN", "1")
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=os.getenv("BULK_WRITE_JOURNAL", "false").lower() == "true")
+
+bulk_writer = LazyProxy(lambda: BulkWriter(BULK_WRITE_BATCH_SIZE, BULK_WRITE_INTERVAL, write_concern_from_env()))
+
+# Lines that start the quoted history of a reply; everything from them on is dropped
+QUOTE_HEADER_PATTERNS = re.compile(
+    r"^(?:On\s.{0,200}\swrote:\s*$"
+    r"|-{2,}\s*Original Message\s*-{2,}"
+    r"|_{10,}\s*$"
+    r"|From:\s.+\n(?:.+\n){0,3}?(?:Sent|Date):\s)",
+    re.IGNORECASE | re.MULTILINE
+)
+# Signature delimiters and boilerplate that start the trailing signature or disclaimer
+SIGNATURE_PATTERNS = re.compile(
+    r"^(?:--\s*$"
+    r"|Sent from my \w+"
+    r"|Get Outlook for \w+"
+    r"|(?:CONFIDENTIALITY NOTICE|DISCLAIMER)\b"
+    r"|This (?:e-?mail|message)(?: and any attachments?)? (?:is|are|may be) (?:confidential|intended))",
+    re.IGNORECASE | re.MULTILINE
+)
+
+def normalize_body(body):
+    """Strip quoted reply history, signatures and disclaimers from an email body.
+
+    Returns the original body (whitespace-tidied) if stripping would leave nothing.
+    """
+    text = (body or "").replace("\r\n", "\n")
+    stripped = text
+    
+    match = QUOTE_HEADER_PATTERNS.search(stripped)
+    if match:
+        stripped = stripped[:match.start()]
+    stripped = "\n".join(line for line in stripped.split("\n") if not line.lstrip().startswith(">"))
+    
+    match = SIGNATURE_PATTERNS.search(stripped)
+    if match:
+        stripped = stripped[:match.start()]
+    
+    if not stripped.strip():
+        stripped = text
+    return re.sub(r"\n{3,}", "\n\n", re.sub(r"[ \t]+\n", "\n", stripped)).strip()
+
+def estimate_tokens(text):
+    """Rough token count for Gemini prompts (about four characters per token)."""
+    return math.ceil(len(text or "") / 4)
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text to a token budget, keeping its beginning and its end."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    
+    max_chars = max_tokens * 4
+    head = int(max_chars * PROMPT_HEAD_RATIO)
+    tail = max_chars - head
+    return f"{text[:head].rstrip()}\n[...]\n{text[-tail:].lstrip() if tail else ''}"
+
+def prompt_text(body, kind):
+    """The part of a normalized body that fits the token budget of one prompt kind."""
+    return truncate_to_tokens(body, PROMPT_TOKEN_BUDGETS[kind])
 
 def calculate_priority(subject, body, sentiment):
     """Calculate priority score (1-5) based on content and sentiment."""
@@ -117,6 +1220,7 @@ def detect_language(text):
 
 def generate_auto_response(body, category, sentiment):
     """Generate an AI-powered auto-response for common inquiries."""
+    body = prompt_text(body, "auto_response")
     prompt = f"""
     Generate a professional, helpful email response to this customer inquiry.
     
@@ -134,102 +1238,449 @@ def generate_auto_response(body, category, sentiment):
     Only return the response text, nothing else.
     """
     
+    cache_key = llm_cache.key("auto_response", body, category, sentiment)
+    cached = llm_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        auto_response = llm_gateway.generate(prompt, "generate_auto_response").strip()
+        llm_cache.set(cache_key, auto_response)
+        return auto_response
     except Exception as e:
         print("Auto-response Generation Error:", e)
         return None
 
-def summarize_email(body):
-    """Generate a concise summary of a long email."""
-    if len(body.split()) < 100:  # Don't summarize short emails
-        return body
-        
-    prompt = f"""
-    Summarize this email in 2-3 sentences while preserving the key points and any specific requests:
+# Customer ID patterns in precedence order: when several match, the earliest entry wins
+CUSTOMER_ID_PATTERNS = [
+    ("customer", r'\bcustomer\s*(?:id|number|#|No)[:.\s]*(?P<customer>[A-Z0-9]{4,15})'),
+    ("account", r'\baccount\s*(?:id|number|#|No)[:.\s]*(?P<account>[A-Z0-9]{4,15})'),
+    ("client", r'\bclient\s*(?:id|number|#|No)[:.\s]*(?P<client>[A-Z0-9]{4,15})'),
+    ("user", r'\buser\s*(?:id|number|#|No)[:.\s]*(?P<user>[A-Z0-9]{4,15})'),
+    
+    ("reference", r'\bref(?:erence)?\s*(?:id|number|#|No)?[:.\s]*(?P<reference>[A-Z0-9]{4,15})'),
+    ("order", r'\border\s*(?:id|number|#|No)[:.\s]*(?P<order>[A-Z0-9]{4,15})'),
+    ("labelled", r'\b(?:id|No)[:.\s]*(?P<labelled>[A-Z0-9]{4,15})'),
     
-    "{body}"
+    ("hash", r'#\s*(?P<hash>[A-Z0-9]{4,15})'),
+    ("cus_prefix", r'\b(?P<cus_prefix>CUS[A-Z0-9]{5,12})\b'),
+    ("acc_prefix", r'\b(?P<acc_prefix>ACC[A-Z0-9]{5,12})\b'),
+    ("id_prefix", r'\b(?P<id_prefix>ID[A-Z0-9]{5,12})\b'),
     
-    Only return the summary, nothing else.
+    ("my_phrase", r'\bmy (?:customer|account|client|reference)? (?:id|number) is[:\s]+(?P<my_phrase>[A-Z0-9]{4,15})'),
+    ("using_phrase", r'\busing (?:customer|account|client|reference)? (?:id|number)[:\s]+(?P<using_phrase>[A-Z0-9]{4,15})'),
+]
+CUSTOMER_ID_PRECEDENCE = {name: rank for rank, (name, _) in enumerate(CUSTOMER_ID_PATTERNS)}
+CUSTOMER_ID_SCANNER = re.compile("|".join(pattern for _, pattern in CUSTOMER_ID_PATTERNS), re.IGNORECASE)
+CUSTOMER_ID_FORMAT_PATTERN = re.compile(CUSTOMER_ID_FORMAT, re.IGNORECASE)
+
+# An ID-like token (letters and digits, at least one digit) close to an ID keyword
+CUSTOMER_ID_HINT_PATTERN = re.compile(
+    r'\b(?:customer|account|acct|client|user|member|ref(?:erence)?|order|id|no|number)\b'
+    r'.{0,40}?\b(?=[A-Z-]*[0-9])[A-Z0-9-]{4,20}\b',
+    re.IGNORECASE | re.DOTALL
+)
+
+customer_id_llm_budget = {"window_start": 0, "used": 0}
+customer_id_llm_budget_lock = threading.Lock()
+
+def match_customer_id(body):
+    """Find a customer ID in the email body using known patterns only.
+
+    All patterns are scanned in a single pass; among the valid candidates the one
+    from the highest-precedence pattern is returned.
     """
+    best_rank, best_id = None, None
+    for match in CUSTOMER_ID_SCANNER.finditer(body):
+        name = match.lastgroup
+        customer_id = match.group(name).strip()
+        rank = CUSTOMER_ID_PRECEDENCE[name]
+        if (best_rank is None or rank < best_rank) and is_valid_customer_id(customer_id):
+            best_rank, best_id = rank, customer_id
+            if rank == 0:
+                break
     
-    try:
-        response = model.generate_content(prompt)
-        return response.text.strip()
-    except Exception as e:
-        print("Email Summarization Error:", e)
-        return body[:300] + "..." if len(body) > 300 else body
-
-def extract_customer_id(body):
-    customer_id_patterns = [
-        r'customer\s*(?:id|ID|number|#|No)[:.\s]*([A-Z0-9]{4,15})',
-        r'account\s*(?:id|ID|number|#|No)[:.\s]*([A-Z0-9]{4,15})',
-        r'client\s*(?:id|ID|number|#|No)[:.\s]*([A-Z0-9]{4,15})',
-        r'user\s*(?:id|ID|number|#|No)[:.\s]*([A-Z0-9]{4,15})',
-        
-        r'ref(?:erence)?\s*(?:id|ID|number|#|No)?[:.\s]*([A-Z0-9]{4,15})',
-        r'order\s*(?:id|ID|number|#|No)[:.\s]*([A-Z0-9]{4,15})',
-        r'(?:id|ID|#|No)[:.\s]*([A-Z0-9]{4,15})',
-        
-        r'#\s*([A-Z0-9]{4,15})',
-        r'\b(CUS[A-Z0-9]{5,12})\b',
-        r'\b(ACC[A-Z0-9]{5,12})\b',
-        r'\b(ID[A-Z0-9]{5,12})\b',
-        
-        r'my (?:customer|account|client|reference)? (?:id|ID|number) is[:\s]+([A-Z0-9]{4,15})',
-        r'using (?:customer|account|client|reference)? (?:id|ID|number)[:\s]+([A-Z0-9]{4,15})'
-    ]
+    return best_id
+
+def is_valid_customer_id(value):
+    """Check whether a value matches the known customer ID format."""
+    return bool(value) and value != "None" and CUSTOMER_ID_FORMAT_PATTERN.fullmatch(value) is not None
+
+def customer_id_hint(body):
+    """Whether the body contains an ID-like token near an ID keyword worth asking the model about."""
+    return CUSTOMER_ID_HINT_PATTERN.search(body) is not None
+
+def take_customer_id_llm_budget():
+    """Consume one model call from the hourly customer ID extraction budget."""
+    with customer_id_llm_budget_lock:
+        now = time.time()
+        if now - customer_id_llm_budget["window_start"] >= 3600:
+            customer_id_llm_budget.update(window_start=now, used=0)
+        if customer_id_llm_budget["used"] >= CUSTOMER_ID_LLM_BUDGET:
+            return False
+        customer_id_llm_budget["used"] += 1
+        return True
+
+@traced("analyze_email")
+def analyze_email(subject, body, raise_errors=False, raw_body=None):
+    """Analyze an email with at most one structured Gemini call.
+
+    Returns category, sentiment, summary, customer ID and a draft reply along with
+    the locally computed language and priority, so forwarding, auto-reply and
+    storage can share one result instead of calling the model again. When the
+    local classifier is confident about category and sentiment, Gemini is only
+    asked for the generated fields, and not called at all if none are needed.
+    Model errors fall back to default labels unless raise_errors is set.
+    
+    body is the normalized text the prompt is built from; raw_body, when given,
+    is the full body scanned for customer IDs, which often sit in signatures.
+    """
+    needs_summary = len(body.split()) > 100
+    id_text = raw_body or body
+    customer_id = match_customer_id(id_text)
+    text = f"{subject} {body}"
+    # Only ask the model for an ID when the body looks like it mentions one and the hourly budget allows
+    asks_customer_id = not customer_id and customer_id_hint(id_text) and take_customer_id_llm_budget()
+    # Lines mentioning an ID that normalization removed (signatures, quotes) are shown to the model separately
+    id_lines = ""
+    if asks_customer_id and not customer_id_hint(body):
+        id_lines = "\n".join(line.strip() for line in id_text.splitlines() if customer_id_hint(line))
+    
+    analysis = {
+        "category": "Unclassified",
+        "sentiment": "Neutral",
+        "summary": "",
+        "customer_id": customer_id,
+        "auto_response": None,
+        "classified_by": "gemini",
+    }
+    
+    local_category = local_classifier.confident_label("category", text)
+    local_sentiment = local_classifier.confident_label("sentiment", text)
+    classified_locally = local_category is not None and local_sentiment is not None
+    if classified_locally:
+        analysis.update(category=local_category, sentiment=local_sentiment, classified_by="local")
+    
+    priority = calculate_priority(subject, body, analysis["sentiment"])
+    wants_reply = not classified_locally or is_auto_reply_eligible(analysis["category"], priority)
+    
+    fields = []
+    if not classified_locally:
+        fields += [
+            '- "category": one of "Technical", "Billing", "Complaint", "General Inquiry"',
+            '- "sentiment": one of "Positive", "Neutral", "Negative", "Very Negative"',
+        ]
+    if needs_summary:
+        fields.append('- "summary": a 2-3 sentence summary preserving the key points and any specific requests')
+    if asks_customer_id:
+        fields.append('- "customer_id": the customer ID or account number if present, otherwise null')
+    if wants_reply:
+        fields.append(
+            '- "draft_reply": a professional, helpful response to the customer that acknowledges their inquiry,\n'
+            '      provides helpful initial information, sets expectations for follow-up if needed,\n'
+            '      is concise (3-5 sentences maximum) and has a professional but warm tone'
+        )
     
-    for pattern in customer_id_patterns:
-        match = re.search(pattern, body, re.IGNORECASE)
-        if match:
-            # Clean up any trailing punctuation
-            customer_id = match.group(1).strip()
-            if customer_id.endswith(('.', ',', ':', ';', ')', ']', '}')):
-                customer_id = customer_id[:-1]
-            return customer_id
+    context = f'Category: {local_category}\n    Customer sentiment: {local_sentiment}\n    ' if classified_locally else ""
+    if id_lines:
+        context += f'Lines from the signature or quoted text: "{id_lines}"\n    '
+    prompt = f"""
+    Analyze the customer email below and respond with a JSON object with exactly these keys:
+    {chr(10).join("    " + field for field in fields).lstrip()}
+    
+    {context}Subject: "{subject}"
+    Message: "{prompt_text(body, "analysis")}"
+    """
     
+    needs_model = not classified_locally or needs_summary or wants_reply or asks_customer_id
     try:
-        prompt = f"""
-        Extract the customer ID or account number from this email if present. 
-        Only respond with the ID/number itself, nothing else.
-        If no customer ID is found, respond with "None".
-        
-        Email: "{body[:1000]}"  # Limit length for API efficiency
-        """
-        
-        response = model.generate_content(prompt)
-        extracted_id = response.text.strip()
-        
-        # Only return if it looks like a valid ID
-        if extracted_id != "None" and re.match(r'^[A-Z0-9]{4,15}$', extracted_id):
-            return extracted_id
+        if needs_model:
+            cache_key = llm_cache.key("analysis", subject, body, local_category, local_sentiment, asks_customer_id, id_lines)
+            result = llm_cache.get(cache_key)
+            if result is None:
+                response_text = llm_gateway.generate(
+                    prompt,
+                    "analyze_email",
+                    generation_config={"response_mime_type": "application/json"}
+                ).strip()
+                if response_text.startswith("```"):
+                    # Strip a markdown code fence if the model added one anyway
+                    response_text = response_text.strip("`").removeprefix("json")
+                result = json.loads(response_text)
+                llm_cache.set(cache_key, result)
+            
+            if not classified_locally:
+                category = str(result.get("category") or "").strip()
+                analysis["category"] = category if category in DEPARTMENTS else "Unclassified"
+                
+                sentiment = str(result.get("sentiment") or "").strip()
+                analysis["sentiment"] = sentiment if sentiment in SENTIMENTS else "Neutral"
+            
+            if needs_summary:
+                analysis["summary"] = str(result.get("summary") or "").strip()
+            
+            extracted_id = str(result.get("customer_id") or "").strip()
+            if asks_customer_id and is_valid_customer_id(extracted_id):
+                analysis["customer_id"] = extracted_id
+            
+            if wants_reply:
+                analysis["auto_response"] = str(result.get("draft_reply") or "").strip() or None
     except Exception as e:
-        print(f"AI extraction error: {str(e)}")
+        print("Email Analysis Error:", e)
+        if raise_errors:
+            raise
+        if not classified_locally:
+            # Default labels, not Gemini's; keeps them out of the classifier's training data
+            analysis["classified_by"] = "fallback"
     
-    return None
+    if needs_summary and not analysis["summary"]:
+        analysis["summary"] = body[:300] + "..." if len(body) > 300 else body
+    
+    analysis["language"] = detect_language(body)
+    analysis["priority"] = calculate_priority(subject, body, analysis["sentiment"])
+    return analysis
 
-def send_auto_response(to_email, auto_response, subject):
-    """Send an automatic acknowledgment to the customer."""
-    try:
-        msg = MIMEMultipart('alternative')
-        msg["Subject"] = f"RE: {subject} [Automated Acknowledgment]"
-        msg["From"] = EMAIL_USER
-        msg["To"] = to_email
-        
-        html_content = f"""
-        <!DOCTYPE html>
-        <html>
-        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
-            <div style="max-width: 600px; margin: 0 auto; padding: 20px; border: 1px solid #ddd; border-radius: 5px;">
-                <div style="border-bottom: 2px solid #4285F4; padding-bottom: 10px; margin-bottom: 20px;">
-                    <h2 style="color: #4285F4; margin: 0;">Thank you for your message</h2>
-                </div>
-                
-                <p>Dear Valued Customer,</p>
-                
-                <p>{auto_response}</p>
+def is_auto_reply_eligible(category, priority):
+    """Whether a drafted reply should be sent to the customer automatically."""
+    return category in ["General Inquiry", "Technical"] or priority <= 3
+
+def analysis_from_document(email_doc, category=None):
+    """Rebuild an analysis result from a stored email without calling Gemini."""
+    return {
+        "category": category or email_doc.get('category', 'Unclassified'),
+        "sentiment": email_doc.get('sentiment', 'Neutral'),
+        "summary": email_doc.get('summary', ''),
+        "customer_id": email_doc.get('customer_id'),
+        "auto_response": None,
+        "language": email_doc.get('language', 'en'),
+        "priority": email_doc.get('priority', 3),
+    }
+
+def simhash(text):
+    """64-bit SimHash of a text's word shingles, or None if the text is too short to compare.
+
+    Words containing digits (order numbers, customer IDs, dates, amounts) are
+    replaced by one placeholder, so templated emails that only differ in those
+    stay within a few bits of each other.
+    """
+    tokens = ["0" if re.search(r"\d", token) else token for token in LocalClassifier.tokenize(text)]
+    if len(tokens) < DUPLICATE_MIN_TOKENS:
+        return None
+    
+    votes = [0] * 64
+    for i in range(len(tokens) - DUPLICATE_SHINGLE_SIZE + 1):
+        shingle = " ".join(tokens[i:i + DUPLICATE_SHINGLE_SIZE])
+        value = int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=8).digest(), "big")
+        for bit in range(64):
+            votes[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if votes[bit] > 0)
+
+class NearDuplicateIndex:
+    """In-memory SimHash index of recently active clusters, synced from the clusters collection.
+
+    Before each lookup the clusters created or joined since the last sync are read
+    (with a short overlap for writes that were in flight), so clusters from other
+    processes are found too. Active clusters are then compared exhaustively, which
+    stays cheap for the number of clusters one window holds and, unlike LSH bands,
+    keeps larger duplicate distances exact. Clusters idle for longer than the
+    window are dropped.
+    """
+
+    SYNC_OVERLAP = timedelta(seconds=60)
+
+    def __init__(self, max_distance, window_hours):
+        self.max_distance = max_distance
+        self.window = timedelta(hours=window_hours)
+        self.clusters = {}  # cluster id -> (fingerprint, last_seen)
+        self.synced_until = None
+        self._lock = threading.Lock()
+
+    def add(self, cluster_id, fingerprint, last_seen):
+        with self._lock:
+            self.clusters[cluster_id] = (fingerprint, last_seen)
+
+    def remove(self, cluster_id):
+        with self._lock:
+            self.clusters.pop(cluster_id, None)
+
+    def _sync(self, now):
+        since = max(self.synced_until or now - self.window, now - self.window)
+        for cluster in clusters_collection.find({"last_seen": {"$gte": since}}, {"fingerprint": 1, "last_seen": 1}):
+            self.add(cluster["_id"], int(cluster["fingerprint"], 16), cluster["last_seen"])
+        self.synced_until = now - self.SYNC_OVERLAP
+
+    def find(self, fingerprint):
+        """Return the id of the closest active cluster within the duplicate distance, or None."""
+        now = datetime.now()
+        self._sync(now)
+        best_id, best_distance = None, self.max_distance + 1
+        with self._lock:
+            for cluster_id, (candidate, last_seen) in list(self.clusters.items()):
+                if now - last_seen > self.window:
+                    del self.clusters[cluster_id]
+                    continue
+                distance = bin(fingerprint ^ candidate).count("1")
+                if distance < best_distance:
+                    best_id, best_distance = cluster_id, distance
+        return best_id
+
+duplicate_index = NearDuplicateIndex(DUPLICATE_MAX_DISTANCE, DUPLICATE_WINDOW_HOURS)
+
+def create_cluster(fingerprint, email_id, message, analysis, to_email):
+    """Start a cluster seeded by a freshly analyzed email."""
+    now = datetime.now()
+    cluster_id = ObjectId()
+    clusters_collection.insert_one({
+        "_id": cluster_id,
+        "fingerprint": f"{fingerprint:016x}",
+        "subject": message["subject"],
+        "analysis": analysis,
+        "to_email": to_email,
+        "count": 1,
+        "email_ids": [email_id],
+        "senders": [message["sender"]],
+        "first_seen": now,
+        "last_seen": now,
+    })
+    duplicate_index.add(cluster_id, fingerprint, now)
+    return cluster_id
+
+def earlier_rival_cluster(cluster_id, fingerprint, since):
+    """A near-duplicate cluster created since `since` that predates this one, or None.
+
+    Two workers analyzing near-duplicates at the same time both miss each other's
+    cluster in the index. Whichever checks second sees the other; if both see each
+    other, the earlier (first_seen, _id) wins, so exactly one of them yields.
+    """
+    own = clusters_collection.find_one({"_id": cluster_id}, {"first_seen": 1})
+    if not own:
+        return None
+    rival = None
+    for cluster in clusters_collection.find(
+        {"_id": {"$ne": cluster_id}, "first_seen": {"$gte": since - NearDuplicateIndex.SYNC_OVERLAP}},
+        {"fingerprint": 1, "first_seen": 1}
+    ):
+        if bin(fingerprint ^ int(cluster["fingerprint"], 16)).count("1") > duplicate_index.max_distance:
+            continue
+        key = (cluster["first_seen"], cluster["_id"])
+        if key < (own["first_seen"], cluster_id) and (rival is None or key < rival):
+            rival = key
+    return rival[1] if rival else None
+
+def discard_cluster(cluster_id):
+    """Delete a cluster that nobody has joined yet; returns False if it already has members."""
+    if clusters_collection.delete_one({"_id": cluster_id, "count": 1}).deleted_count != 1:
+        return False
+    duplicate_index.remove(cluster_id)
+    return True
+
+def join_cluster(cluster_id, email_id, sender):
+    """Add an email to a cluster once (retries are no-ops) and return the cluster."""
+    now = datetime.now()
+    cluster = clusters_collection.find_one_and_update(
+        {"_id": cluster_id, "email_ids": {"$ne": email_id}},
+        {
+            "$inc": {"count": 1},
+            "$push": {
+                "email_ids": {"$each": [email_id], "$slice": -1000},
+                "senders": {"$each": [sender], "$slice": -20},
+            },
+            "$set": {"last_seen": now},
+        },
+        return_document=ReturnDocument.AFTER
+    )
+    return cluster or clusters_collection.find_one({"_id": cluster_id})
+
+def cluster_analysis(cluster, raw_body, member):
+    if not member:
+        return cluster["analysis"]
+    return dict(cluster["analysis"], customer_id=match_customer_id(raw_body), classified_by="cluster")
+
+def analyze_with_clusters(job, message, body, raise_errors):
+    """Analyze a message, reusing the analysis of a near-duplicate cluster when one matches.
+
+    The cluster membership is saved on the job as soon as it is decided, so a
+    retry of the stage keeps the same role instead of finding the email's own
+    cluster and counting it as a duplicate of itself. Returns the analysis and
+    the job fields describing the membership.
+    """
+    if job.get("cluster_id"):
+        cluster = clusters_collection.find_one({"_id": job["cluster_id"]})
+        if cluster:
+            membership = {key: job[key] for key in ("cluster_id", "cluster_count", "cluster_member") if key in job}
+            return cluster_analysis(cluster, message["body"], job.get("cluster_member")), membership
+    
+    looked_up_at = datetime.now()
+    fingerprint = simhash(f"{message['subject']} {body}")
+    cluster_id = duplicate_index.find(fingerprint) if fingerprint is not None else None
+    if cluster_id:
+        existing = clusters_collection.find_one({"_id": cluster_id}, {"email_ids": {"$slice": 1}})
+        if not existing:
+            # Discarded after losing a creation race in another process
+            duplicate_index.remove(cluster_id)
+        founder = existing and existing.get("email_ids", [None])[0] == job["email_id"]
+        cluster = None if founder else join_cluster(cluster_id, job["email_id"], message["sender"])
+        if founder or cluster:
+            cluster = cluster or clusters_collection.find_one({"_id": cluster_id})
+            membership = {"cluster_id": cluster_id, "cluster_member": not founder}
+            if not founder:
+                membership["cluster_count"] = cluster["count"]
+            update_job(job, membership)
+            return cluster_analysis(cluster, message["body"], not founder), membership
+    
+    analysis = analyze_email(message["subject"], body, raise_errors=raise_errors, raw_body=message["body"])
+    if fingerprint is not None:
+        cluster_id = create_cluster(fingerprint, job["email_id"], message, analysis, department_email(analysis["category"]))
+        rival_id = earlier_rival_cluster(cluster_id, fingerprint, looked_up_at)
+        if rival_id and discard_cluster(cluster_id):
+            cluster = join_cluster(rival_id, job["email_id"], message["sender"])
+            membership = {"cluster_id": rival_id, "cluster_member": True, "cluster_count": cluster["count"]}
+            update_job(job, membership)
+            return cluster_analysis(cluster, message["body"], True), membership
+        membership = {"cluster_id": cluster_id, "cluster_member": False}
+        update_job(job, membership)
+        return analysis, membership
+    return analysis, {}
+
+def get_active_clusters(limit=10):
+    """Clusters with more than one email seen within the duplicate window, largest first."""
+    since = datetime.now() - timedelta(hours=DUPLICATE_WINDOW_HOURS)
+    clusters = clusters_collection.find(
+        {"last_seen": {"$gte": since}, "count": {"$gt": 1}},
+        {"subject": 1, "count": 1, "analysis.category": 1, "analysis.summary": 1, "first_seen": 1, "last_seen": 1}
+    ).sort("count", DESCENDING).limit(limit)
+    return [{
+        "id": str(cluster["_id"]),
+        "subject": cluster.get("subject", ""),
+        "category": cluster.get("analysis", {}).get("category", "Unclassified"),
+        "count": cluster["count"],
+        "first_seen": cluster["first_seen"],
+        "last_seen": cluster["last_seen"],
+    } for cluster in clusters]
+
+@traced("send_auto_response")
+def send_auto_response(to_email, auto_response, subject, headers=None):
+    """Send an automatic acknowledgment to the customer."""
+    try:
+        msg = MIMEMultipart('alternative')
+        msg["Subject"] = f"RE: {subject} [Automated Acknowledgment]"
+        msg["From"] = EMAIL_USER
+        msg["To"] = to_email
+        for name, value in (headers or {}).items():
+            msg[name] = value
+        
+        html_content = f"""
+        <!DOCTYPE html>
+        <html>
+        <body style="font-family: Arial, sans-serif; line-height: 1.6; color: #333;">
+            <div style="max-width: 600px; margin: 0 auto; padding: 20px; border: 1px solid #ddd; border-radius: 5px;">
+                <div style="border-bottom: 2px solid #4285F4; padding-bottom: 10px; margin-bottom: 20px;">
+                    <h2 style="color: #4285F4; margin: 0;">Thank you for your message</h2>
+                </div>
+                
+                <p>Dear Valued Customer,</p>
+                
+                <p>{auto_response}</p>
                 
                 <p style="margin-top: 30px;">Best regards,<br>
                 Smart Email Management System<br>
@@ -260,12 +1711,9 @@ def send_auto_response(to_email, auto_response, subject):
         msg.attach(part1)
         msg.attach(part2)
         
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(EMAIL_USER, EMAIL_PASS)
-            server.send_message(msg)
-            print(f"Auto-response sent to {to_email}")
-            return True
+        smtp_pool.send_message(msg)
+        print(f"Auto-response sent to {to_email}")
+        return True
     except Exception as e:
         print(f"Auto-response error: {str(e)}")
         return False
@@ -432,14 +1880,17 @@ def create_email_template(subject, body, category, sender, sentiment="", priorit
     """
     return html
 
-def forward_email(subject, body, to_email, sender):
+@traced("forward_email")
+def forward_email(subject, body, to_email, sender, analysis=None):
     try:
-        category = classify_email(body)
-        sentiment = analyze_sentiment(body)
-        language = detect_language(body)
-        summary = summarize_email(body) if len(body.split()) > 100 else ""
-        customer_id = extract_customer_id(body)
-        priority = calculate_priority(subject, body, sentiment)
+        if analysis is None:
+            analysis = analyze_email(subject, body)
+        category = analysis["category"]
+        sentiment = analysis["sentiment"]
+        language = analysis["language"]
+        summary = analysis["summary"]
+        customer_id = analysis["customer_id"]
+        priority = analysis["priority"]
         
         msg = MIMEMultipart('alternative')
         msg["Subject"] = f"[{category}][P{priority}] {subject}"
@@ -457,320 +1908,1769 @@ def forward_email(subject, body, to_email, sender):
 
         print(f"Attempting to forward email to {to_email}...")
         
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(EMAIL_USER, EMAIL_PASS)
-            server.send_message(msg)
-            print(f"Email successfully forwarded to {to_email}")
+        smtp_pool.send_message(msg)
+        print(f"Email successfully forwarded to {to_email}")
+        return True
+    except Exception as e:
+        print(f"Email forwarding error: {str(e)}")
+        return False
+
+@traced("forward_cluster_notice")
+def forward_cluster_notice(cluster, to_email):
+    """Send a department one consolidated notice about a growing cluster of near-identical emails."""
+    try:
+        analysis = cluster["analysis"]
+        subject = cluster["subject"]
+        senders = "\n".join(f"  - {sender}" for sender in cluster.get("senders", []))
+        
+        msg = MIMEMultipart('alternative')
+        msg["Subject"] = f"[{analysis['category']}][Cluster] {cluster['count']} similar emails: {subject}"
+        msg["From"] = EMAIL_USER
+        msg["To"] = to_email
+        
+        text_content = (
+            f"{cluster['count']} near-identical emails have arrived since "
+            f"{cluster['first_seen'].strftime('%Y-%m-%d %H:%M')} (latest {cluster['last_seen'].strftime('%Y-%m-%d %H:%M')}).\n\n"
+            f"Subject of the first email: {subject}\n\n"
+            f"Summary: {analysis.get('summary') or 'Not available'}\n\n"
+            f"Most recent senders:\n{senders}\n\n"
+            "Only the first email of the cluster was forwarded individually; further notices are sent as the cluster grows.\n\n"
+            "This email was automatically sent by the Smart Email Management System."
+        )
+        msg.attach(MIMEText(text_content, 'plain'))
+        
+        smtp_pool.send_message(msg)
+        return True
+    except Exception as e:
+        print(f"Cluster notice error: {str(e)}")
+        return False
+
+def search_terms(text, limit=SEARCH_TERMS_LIMIT):
+    """The distinct words of a body, in order of appearance, kept on the hot document for search."""
+    return " ".join(list(dict.fromkeys(LocalClassifier.tokenize(text)))[:limit])
+
+def split_cold_fields(doc, fields):
+    """Move a document's long text fields into a compressed blob.
+
+    The fields are removed from the document in place and listed in its
+    cold_fields; returns the upsert for the blob store, or None when every field
+    is short enough to stay inline.
+    """
+    cold = {field: zlib.compress(doc[field].encode("utf-8"), COLD_COMPRESSION_LEVEL)
+            for field in fields if len(doc.get(field) or "") >= COLD_TEXT_MIN_CHARS}
+    if not cold:
+        return None
+    
+    size = sum(len(doc.pop(field).encode("utf-8")) for field in cold)
+    doc["cold_fields"] = sorted(cold)
+    return UpdateOne({"_id": doc["_id"]}, {"$set": {"fields": cold, "size": size}}, upsert=True)
+
+def insert_with_blob(collection, doc, blob):
+    """Insert a document and upsert its cold-field blob in the same flush, waiting once for both.
+
+    If the blob fails after the document was inserted, the document is deleted again
+    so it never points at a missing body, and the caller's retry writes both.
+    """
+    futures = [bulk_writer.submit(collection, InsertOne(doc))]
+    if blob:
+        futures.append(bulk_writer.submit(blobs_collection, blob))
+    wait(futures, BULK_WRITE_TIMEOUT)
+    errors = [future.exception(0) for future in futures]
+    if blob and errors[1]:
+        if not errors[0]:
+            collection.delete_one({"_id": doc["_id"]})
+        raise errors[1]
+    if errors[0]:
+        raise errors[0]
+
+def hydrate_documents(docs):
+    """Fill in the cold fields of emails or responses from the blob store, with one query for all of them."""
+    cold_ids = [doc["_id"] for doc in docs if doc.get("cold_fields")]
+    if not cold_ids:
+        return docs
+    
+    blobs = {blob["_id"]: blob["fields"] for blob in blobs_collection.find({"_id": {"$in": cold_ids}})}
+    for doc in docs:
+        fields = blobs.get(doc["_id"], {})
+        for field in doc.get("cold_fields", []):
+            if field in fields:
+                doc[field] = zlib.decompress(fields[field]).decode("utf-8")
+    return docs
+
+def hydrated_batches(cursor, batch_size):
+    """Iterate a cursor with the cold fields of each batch of documents filled in."""
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield from hydrate_documents(batch)
+            batch = []
+    yield from hydrate_documents(batch)
+
+def hydrate_document(doc):
+    if doc:
+        hydrate_documents([doc])
+    return doc
+
+@traced("store_email")
+def store_email(category, sender, subject, body, forwarded_to=None, analysis=None, metadata=None):
+    try:
+        if analysis is None:
+            analysis = analyze_email(subject, body)
+        
+        email_doc = {
+            "category": category,
+            "sender": sender,
+            "subject": subject,
+            "body": body,
+            "preview": body[:EMAIL_PREVIEW_LENGTH],
+            "summary": analysis["summary"],
+            "forwarded_to": forwarded_to,
+            "sentiment": analysis["sentiment"],
+            "priority": analysis["priority"],
+            "language": analysis["language"],
+            "customer_id": analysis["customer_id"],
+            "classified_by": analysis.get("classified_by", "gemini"),
+            "response_time": None,
+            "status": "pending",
+            "timestamp": datetime.now()
+        }
+        email_doc.update(metadata or {})
+        email_doc.setdefault("_id", ObjectId())
+        email_doc["search_terms"] = search_terms(email_doc.get("normalized_body") or body)
+        
+        blob = split_cold_fields(email_doc, ["body", "normalized_body"])
+        insert_with_blob(emails_collection, email_doc, blob)
+        record_rollup_change(None, email_doc)
+        return True
+    except DuplicateKeyError:
+        # Already stored by an earlier attempt of the same job
+        return True
+    except Exception as e:
+        print("Database Error:", e)
+        return False
+
+def parse_message_ids(value):
+    """Extract the <id@host> message IDs from a Message-ID, In-Reply-To or References value."""
+    return re.findall(r"<[^<>\s]+>", _to_text(value))
+
+def resolve_thread_key(message):
+    """Find the conversation a message belongs to from its In-Reply-To and References headers.
+
+    A known conversation containing any referenced message wins; otherwise the
+    root of the References chain (or the message itself) starts a new thread.
+    """
+    related = message.get("references", []) + parse_message_ids(message.get("in_reply_to"))
+    if related:
+        conversation = conversations_collection.find_one({"message_ids": {"$in": related}}, {"_id": 1})
+        if conversation:
+            return conversation["_id"]
+        return related[0]
+    return message.get("message_id") or f"uid:{message['uidvalidity']}:{message['uid']}"
+
+def record_conversation_email(thread_key, email_id, message):
+    """Add an inbound email and the message IDs it references to its conversation."""
+    message_ids = message.get("references", []) + parse_message_ids(message.get("in_reply_to"))
+    message_ids += parse_message_ids(message.get("message_id"))
+    now = datetime.now()
+    conversations_collection.update_one(
+        {"_id": thread_key},
+        {
+            "$setOnInsert": {"subject": message["subject"], "started_at": now},
+            "$addToSet": {
+                "message_ids": {"$each": message_ids},
+                "email_ids": email_id,
+                "participants": message["sender"],
+            },
+            "$set": {"last_activity": now},
+        },
+        upsert=True
+    )
+
+def record_conversation_reply(thread_key, message_id, subject):
+    """Remember an outbound reply so the customer's answer to it joins the same conversation.
+
+    Auto-responses go out before the inbound email is stored, so the reply may
+    be the first message recorded for a new thread.
+    """
+    if thread_key and message_id:
+        now = datetime.now()
+        conversations_collection.update_one(
+            {"_id": thread_key},
+            {
+                "$setOnInsert": {"subject": subject, "started_at": now},
+                "$addToSet": {"message_ids": message_id},
+                "$set": {"last_activity": now},
+            },
+            upsert=True
+        )
+
+def reply_headers(message_id, references=()):
+    """Threading headers for a reply to an inbound message, with a fresh Message-ID."""
+    headers = {"Message-ID": make_msgid(domain=(EMAIL_USER or "localhost").split("@")[-1])}
+    if message_id:
+        headers["In-Reply-To"] = message_id
+        headers["References"] = " ".join(list(references) + [message_id])
+    return headers
+
+@traced("store_auto_response")
+def store_auto_response(recipient, subject, response_text, category, is_auto=True, email_id=None):
+    """Store auto-generated responses in the database, linked to the email they answer."""
+    try:
+        response_doc = {
+            "email_id": email_id,
+            "recipient": recipient,
+            "subject": subject,
+            "response_text": response_text,
+            "category": category,
+            "is_auto": is_auto,
+            "timestamp": datetime.now(),
+            "_id": ObjectId()
+        }
+        blob = split_cold_fields(response_doc, ["response_text"])
+        insert_with_blob(responses_collection, response_doc, blob)
+        return True
+    except Exception as e:
+        print("Response Storage Error:", e)
+        return False
+
+def _rollup_key(value):
+    # Field names inside rollup documents cannot contain "." or start with "$"
+    return str(value).replace(".", "_").replace("$", "_")
+
+# Email fields the rollup counters are derived from
+ROLLUP_FIELDS = {"category": 1, "sentiment": 1, "priority": 1, "language": 1,
+                 "status": 1, "timestamp": 1, "response_time": 1}
+
+def rollup_increments(email_doc, sign=1):
+    """Flattened $inc counters an email contributes to its rollup buckets."""
+    category = _rollup_key(email_doc.get('category') or 'Unclassified')
+    status = _rollup_key(email_doc.get('status') or 'pending')
+    increments = {
+        "total": sign,
+        f"category.{category}": sign,
+        f"sentiment.{_rollup_key(email_doc.get('sentiment') or 'Neutral')}": sign,
+        f"priority.{email_doc.get('priority') or 3}": sign,
+        f"language.{_rollup_key(email_doc.get('language') or 'en')}": sign,
+        f"status.{status}": sign,
+        f"category_status.{category}.{status}": sign,
+    }
+    
+    if status == "resolved" and email_doc.get('response_time') and email_doc.get('timestamp'):
+        hours = (email_doc['response_time'] - email_doc['timestamp']).total_seconds() / 3600
+        increments["response.sum_hours"] = sign * hours
+        increments["response.count"] = sign
+        increments[f"category_response.{category}.sum_hours"] = sign * hours
+        increments[f"category_response.{category}.count"] = sign
+    return increments
+
+def rollup_buckets(timestamp):
+    """The hourly and daily rollup buckets a received timestamp falls into."""
+    hour = timestamp.replace(minute=0, second=0, microsecond=0)
+    return [("hour", hour), ("day", hour.replace(hour=0))]
+
+def rollup_updates(timestamp, increments):
+    return [
+        UpdateOne(
+            {"_id": f"{granularity}:{start.isoformat()}"},
+            {"$inc": increments, "$setOnInsert": {"granularity": granularity, "start": start}},
+            upsert=True
+        )
+        for granularity, start in rollup_buckets(timestamp)
+    ]
+
+def record_rollup_change(before, after):
+    """Move an email's contribution in the rollups from its old state to its new one.
+
+    Pass before=None for a newly stored email. Counts are kept in the buckets of
+    the email's received timestamp, so a status change updates the day the email
+    arrived rather than the day it was resolved.
+    """
+    record_rollup_changes([(before, after)])
+
+def record_rollup_changes(changes):
+    """Apply several (before, after) rollup moves, merged per hour, in one bulk_write."""
+    try:
+        hours = {}
+        for before, after in changes:
+            timestamp = (after or before).get('timestamp')
+            if not timestamp:
+                continue
+            increments = hours.setdefault(timestamp.replace(minute=0, second=0, microsecond=0), {})
+            for email_doc, sign in ((before, -1), (after, 1)):
+                if email_doc:
+                    for key, value in rollup_increments(email_doc, sign).items():
+                        increments[key] = increments.get(key, 0) + value
+        
+        updates = []
+        for hour, increments in hours.items():
+            increments = {key: value for key, value in increments.items() if value}
+            if increments:
+                updates += rollup_updates(hour, increments)
+        if updates:
+            metrics_collection.bulk_write(updates, ordered=False)
+    except Exception as e:
+        print("Rollup Update Error:", e)
+
+def rebuild_rollups(batch_size=1000):
+    """Recompute every rollup document from the stored emails.
+
+    Meant to be run offline (for example after an upgrade); emails stored while
+    it runs may be counted twice or not at all.
+    """
+    metrics_collection.delete_many({})
+    
+    buckets = {}
+    for email_doc in emails_collection.find({"timestamp": {"$ne": None}}, ROLLUP_FIELDS).batch_size(batch_size):
+        for bucket in rollup_buckets(email_doc['timestamp']):
+            counters = buckets.setdefault(bucket, {})
+            for key, value in rollup_increments(email_doc).items():
+                counters[key] = counters.get(key, 0) + value
+    
+    updates = []
+    for (granularity, start), increments in buckets.items():
+        updates.append(UpdateOne(
+            {"_id": f"{granularity}:{start.isoformat()}"},
+            {"$inc": increments, "$setOnInsert": {"granularity": granularity, "start": start}},
+            upsert=True
+        ))
+        if len(updates) >= batch_size:
+            metrics_collection.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        metrics_collection.bulk_write(updates, ordered=False)
+    return len(buckets)
+
+@bp.cli.command("rebuild-rollups")
+def rebuild_rollups_command():
+    """Backfill the hourly and daily analytics rollups from existing emails."""
+    print(f"Rebuilt {rebuild_rollups()} rollup bucket(s)")
+
+def sum_rollups(granularity, since):
+    """Add up the rollup documents of one granularity starting at or after a time."""
+    totals = {"total": 0, "category": {}, "sentiment": {}, "priority": {}, "language": {},
+              "status": {}, "category_status": {}, "response": {}, "category_response": {}}
+    
+    def merge(target, source):
+        for key, value in source.items():
+            if isinstance(value, dict):
+                merge(target.setdefault(key, {}), value)
+            else:
+                target[key] = target.get(key, 0) + value
+    
+    docs = list(metrics_collection.find({"granularity": granularity, "start": {"$gte": since}}))
+    for doc in docs:
+        merge(totals, {key: value for key, value in doc.items() if key in totals})
+    return totals, docs
+
+# List views never need the body; "preview" holds its first EMAIL_PREVIEW_LENGTH characters
+EMAIL_LIST_PROJECTION = {
+    "category": 1, "sender": 1, "subject": 1, "preview": 1, "summary": 1,
+    "sentiment": 1, "priority": 1, "language": 1, "customer_id": 1,
+    "forwarded_to": 1, "timestamp": 1, "status": 1,
+}
+
+def encode_cursor(email_doc):
+    """Encode the (timestamp, _id) position of a document as an opaque page cursor."""
+    position = f"{email_doc['timestamp'].isoformat()}|{email_doc['_id']}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+def decode_cursor(cursor):
+    timestamp, email_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(timestamp), ObjectId(email_id)
+
+def format_email_summary(email_doc):
+    return {
+        "_id": str(email_doc['_id']),  # Convert ObjectId to string to make it accessible in templates
+        "from": email_doc.get('sender', ''),
+        "subject": email_doc.get('subject', ''),
+        "preview": email_doc.get('preview', ''),
+        "summary": email_doc.get('summary', ''),
+        "sentiment": email_doc.get('sentiment', 'Neutral'),
+        "priority": email_doc.get('priority', 3),
+        "language": email_doc.get('language', 'en'),
+        "customer_id": email_doc.get('customer_id', ''),
+        "forwarded_to": email_doc.get('forwarded_to', 'Not recorded'),
+        "category": email_doc.get('category', 'Unclassified'),
+        "timestamp": email_doc['timestamp'],
+        "status": email_doc.get('status', 'pending')
+    }
+
+def get_email_page(category, cursor=None, limit=DASHBOARD_PAGE_SIZE):
+    """Get one page of a category's emails, newest first, using keyset pagination."""
+    query = {"category": category}
+    if cursor:
+        timestamp, email_id = decode_cursor(cursor)
+        query["$or"] = [
+            {"timestamp": {"$lt": timestamp}},
+            {"timestamp": timestamp, "_id": {"$lt": email_id}}
+        ]
+    
+    # Fetch one extra document to know whether another page exists
+    docs = list(emails_collection.find(query, EMAIL_LIST_PROJECTION)
+                .sort([("timestamp", -1), ("_id", -1)])
+                .limit(limit + 1))
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    
+    return {
+        "emails": [format_email_summary(doc) for doc in docs],
+        "next_cursor": encode_cursor(docs[-1]) if has_more else None
+    }
+
+def get_category_counts():
+    """Count emails per category with a single aggregation."""
+    counts = emails_collection.aggregate([
+        {"$group": {"_id": "$category", "count": {"$sum": 1}}}
+    ])
+    return {doc["_id"] or "Unclassified": doc["count"] for doc in counts}
+
+def get_emails_by_category():
+    """Get the first page of every category along with per-category totals."""
+    categories = list(DEPARTMENTS.keys()) + ["Unclassified"]
+    try:
+        counts = get_category_counts()
+        categories += [category for category in counts if category not in categories]
+        
+        email_data = {}
+        for category in categories:
+            page = get_email_page(category) if counts.get(category) else {"emails": [], "next_cursor": None}
+            email_data[category] = {
+                "emails": page["emails"],
+                "total": counts.get(category, 0),
+                "next_cursor": page["next_cursor"]
+            }
+            
+        return email_data
+    except Exception as e:
+        print("Database Read Error:", e)
+        return {category: {"emails": [], "total": 0, "next_cursor": None} for category in categories}
+
+class LocalSearchIndex:
+    """In-process inverted index used when MongoDB text search is unavailable.
+
+    Postings hold field-weighted term frequencies for the searchable fields.
+    The index is built on first use and topped up with newer emails before every
+    search; filters are applied by MongoDB afterwards, so they always reflect the
+    current status and category.
+    """
+
+    def __init__(self, field_weights, max_body_tokens=2000):
+        self.field_weights = field_weights
+        self.max_body_tokens = max_body_tokens
+        self.postings = {}  # term -> {email_id: weighted frequency}
+        self.indexed_ids = set()
+        self.indexed_until = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        query = {"timestamp": {"$gte": self.indexed_until}} if self.indexed_until else {}
+        projection = {field: 1 for field in self.field_weights}
+        projection["timestamp"] = 1
+        for email_doc in emails_collection.find(query, projection).sort("timestamp", ASCENDING):
+            self.add(email_doc)
+
+    def add(self, email_doc):
+        if email_doc["_id"] in self.indexed_ids:
+            return
+        for field, weight in self.field_weights.items():
+            tokens = LocalClassifier.tokenize(str(email_doc.get(field) or ""))
+            for token in tokens[:self.max_body_tokens]:
+                postings = self.postings.setdefault(token, {})
+                postings[email_doc["_id"]] = postings.get(email_doc["_id"], 0) + weight
+        self.indexed_ids.add(email_doc["_id"])
+        if email_doc.get("timestamp") and (self.indexed_until is None or email_doc["timestamp"] > self.indexed_until):
+            self.indexed_until = email_doc["timestamp"]
+
+    def search(self, text):
+        """Score emails by TF-IDF over the query terms; returns {email_id: score}."""
+        with self._lock:
+            self.refresh()
+            scores = {}
+            for term in set(LocalClassifier.tokenize(text)):
+                postings = self.postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + len(self.indexed_ids) / len(postings))
+                for email_id, frequency in postings.items():
+                    scores[email_id] = scores.get(email_id, 0) + (1 + math.log(frequency)) * idf
+            return scores
+
+local_search_index = LocalSearchIndex(SEARCH_FIELD_WEIGHTS)
+
+def build_search_filters(category=None, status=None, priority=None, date_from=None, date_to=None):
+    """MongoDB filter for the optional search facets; dates are YYYY-MM-DD and inclusive."""
+    filters = {}
+    if category:
+        filters["category"] = category
+    if status:
+        filters["status"] = status
+    if priority:
+        filters["priority"] = int(priority)
+    if date_from or date_to:
+        filters["timestamp"] = {}
+        if date_from:
+            filters["timestamp"]["$gte"] = datetime.strptime(date_from, "%Y-%m-%d")
+        if date_to:
+            filters["timestamp"]["$lt"] = datetime.strptime(date_to, "%Y-%m-%d") + timedelta(days=1)
+    return filters
+
+def search_emails_text(text, filters, skip, limit):
+    """Rank with the MongoDB text index; returns one extra document to detect another page."""
+    projection = {**EMAIL_LIST_PROJECTION, "score": {"$meta": "textScore"}}
+    return list(emails_collection.find({"$text": {"$search": text}, **filters}, projection)
+                .sort([("score", {"$meta": "textScore"}), ("timestamp", DESCENDING)])
+                .skip(skip)
+                .limit(limit + 1))
+
+def search_emails_local(text, filters, skip, limit):
+    scores = local_search_index.search(text)
+    candidates = sorted(scores, key=scores.get, reverse=True)[:SEARCH_MAX_RESULTS]
+    if not candidates:
+        return []
+    
+    docs = list(emails_collection.find({"_id": {"$in": candidates}, **filters}, EMAIL_LIST_PROJECTION))
+    for doc in docs:
+        doc["score"] = scores[doc["_id"]]
+    docs.sort(key=lambda doc: (doc["score"], doc["timestamp"]), reverse=True)
+    return docs[skip:skip + limit + 1]
+
+def search_emails(text, page=1, limit=DASHBOARD_PAGE_SIZE, **facets):
+    """Ranked search over subject, body, summary, sender and customer ID.
+
+    Uses the MongoDB text index unless SEARCH_BACKEND is "local", and falls back
+    to the in-process inverted index when text search fails (for example when
+    the index has not been created). Without search text the filtered emails are
+    listed newest first.
+    """
+    filters = build_search_filters(**facets)
+    skip = (page - 1) * limit
+    if skip >= SEARCH_MAX_RESULTS:
+        return {"results": [], "page": page, "next_page": None, "backend": None}
+    
+    if not text:
+        # Filters only: newest first, no ranking
+        docs = list(emails_collection.find(filters, EMAIL_LIST_PROJECTION)
+                    .sort([("timestamp", DESCENDING), ("_id", DESCENDING)])
+                    .skip(skip)
+                    .limit(limit + 1))
+        backend = None
+    else:
+        backend = "local" if SEARCH_BACKEND == "local" else "text"
+    
+    if backend == "text":
+        try:
+            docs = search_emails_text(text, filters, skip, limit)
+        except OperationFailure as e:
+            print("Text Search Error, using local index:", e)
+            backend = "local"
+    if backend == "local":
+        docs = search_emails_local(text, filters, skip, limit)
+    
+    has_more = len(docs) > limit and skip + limit < SEARCH_MAX_RESULTS
+    results = []
+    for doc in docs[:limit]:
+        result = format_email_summary(doc)
+        result["score"] = round(doc.get("score", 0), 3)
+        results.append(result)
+    
+    return {"results": results, "page": page, "next_page": page + 1 if has_more else None, "backend": backend}
+
+HOURS_TO_RESPOND = {"$divide": [{"$subtract": ["$response_time", "$timestamp"]}, 3600 * 1000]}
+
+def _count_by(field, default):
+    """$facet branch counting documents per value of a field."""
+    return [{"$group": {"_id": {"$ifNull": [f"${field}", default]}, "count": {"$sum": 1}}}]
+
+def generate_weekly_report_live():
+    """Generate a weekly analytics report with a single aggregation over the emails."""
+    try:
+        now = datetime.now()
+        one_week_ago = now - timedelta(days=7)
+        
+        facets = next(emails_collection.aggregate([
+            {"$match": {"timestamp": {"$gte": one_week_ago}}},
+            {"$facet": {
+                "total": [{"$count": "count"}],
+                "categories": _count_by("category", "Unclassified"),
+                "sentiments": _count_by("sentiment", "Neutral"),
+                "priorities": _count_by("priority", 3),
+                "languages": _count_by("language", "en"),
+                "response_time": [
+                    {"$match": {"status": "resolved", "response_time": {"$ne": None}}},
+                    {"$group": {"_id": None, "avg": {"$avg": HOURS_TO_RESPOND}}}
+                ],
+                "by_category": [
+                    {"$group": {"_id": {"category": "$category", "status": "$status"}, "count": {"$sum": 1}}}
+                ]
+            }}
+        ]))
+        
+        sentiments = {"Positive": 0, "Neutral": 0, "Negative": 0, "Very Negative": 0}
+        sentiments.update({doc["_id"]: doc["count"] for doc in facets["sentiments"]})
+        priorities = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
+        priorities.update({doc["_id"]: doc["count"] for doc in facets["priorities"]})
+        
+        report = {
+            "period": {
+                "start": one_week_ago.strftime("%Y-%m-%d"),
+                "end": now.strftime("%Y-%m-%d")
+            },
+            "total_emails": facets["total"][0]["count"] if facets["total"] else 0,
+            "categories": {doc["_id"]: doc["count"] for doc in facets["categories"]},
+            "sentiments": sentiments,
+            "priorities": priorities,
+            "languages": {doc["_id"]: doc["count"] for doc in facets["languages"]},
+            "response_metrics": {
+                "avg_response_time": facets["response_time"][0]["avg"] if facets["response_time"] else 0
+            },
+            "by_category": {}
+        }
+        
+        status_counts = {(doc["_id"].get("category"), doc["_id"].get("status")): doc["count"]
+                         for doc in facets["by_category"]}
+        for category in list(DEPARTMENTS.keys()) + ["Unclassified"]:
+            completed = status_counts.get((category, "resolved"), 0)
+            pending = status_counts.get((category, "pending"), 0) + status_counts.get((category, "in-progress"), 0)
             
-            auto_response = generate_auto_response(body, category, sentiment)
-            if auto_response:
-                store_auto_response(sender, subject, auto_response, category)
-                if category in ["General Inquiry", "Technical"] or priority <= 3:
-                    send_auto_response(sender, auto_response, subject)
+            report["by_category"][category] = {
+                "total": completed + pending,
+                "completed": completed,
+                "pending": pending
+            }
             
-            return True
+        return report
+    
     except Exception as e:
-        print(f"Email forwarding error: {str(e)}")
+        print("Weekly Report Generation Error:", e)
+        return {}
+
+def get_response_statistics_live():
+    """Get statistics about response times and volumes with a single aggregation over the emails."""
+    try:
+        now = datetime.now()
+        seven_days_ago = now - timedelta(days=7)
+        thirty_days_ago = now - timedelta(days=30)
+        categories = list(DEPARTMENTS.keys()) + ["Unclassified"]
+        
+        facets = next(emails_collection.aggregate([
+            {"$match": {"timestamp": {"$gte": thirty_days_ago}}},
+            {"$facet": {
+                # Day i covers [now - (i + 1) days, now - i days)
+                "daily": [
+                    {"$match": {"timestamp": {"$gte": seven_days_ago, "$lt": now}}},
+                    {"$group": {
+                        "_id": {"$subtract": [
+                            {"$ceil": {"$divide": [{"$subtract": [now, "$timestamp"]}, 86400 * 1000]}}, 1
+                        ]},
+                        "count": {"$sum": 1}
+                    }}
+                ],
+                "categories": _count_by("category", "Unclassified"),
+                "priorities": _count_by("priority", 3),
+                "avg_times": [
+                    {"$match": {"status": "resolved", "response_time": {"$ne": None}}},
+                    {"$group": {"_id": "$category", "avg": {"$avg": HOURS_TO_RESPOND}}}
+                ],
+                "total_responses": [
+                    {"$match": {"status": "resolved", "timestamp": {"$gte": seven_days_ago}}},
+                    {"$count": "count"}
+                ]
+            }}
+        ]))
+        
+        # Daily response counts for the last 7 days
+        daily = {int(doc["_id"]): doc["count"] for doc in facets["daily"]}
+        daily_counts = [{
+            "date": (now - timedelta(days=i+1)).strftime("%Y-%m-%d"),
+            "count": daily.get(i, 0)
+        } for i in range(7)]
+        
+        category_counts = {doc["_id"]: doc["count"] for doc in facets["categories"]}
+        priority_counts = {doc["_id"]: doc["count"] for doc in facets["priorities"]}
+        avg_times = {doc["_id"]: doc["avg"] for doc in facets["avg_times"]}
+        
+        return {
+            "daily_counts": daily_counts,
+            "categories": {cat: category_counts.get(cat, 0) for cat in categories},
+            "priorities": {p: priority_counts.get(p, 0) for p in range(1, 6)},
+            "avg_response_times": {cat: avg_times.get(cat) or 0 for cat in categories},
+            "total_responses": facets["total_responses"][0]["count"] if facets["total_responses"] else 0
+        }
+    except Exception as e:
+        print("Response Statistics Error:", e)
+        return {}
+
+def _average_hours(response):
+    return response["sum_hours"] / response["count"] if response.get("count") else 0
+
+def generate_weekly_report():
+    """Generate a weekly analytics report from the hourly rollups."""
+    if ANALYTICS_SOURCE != "rollups":
+        return generate_weekly_report_live()
+    try:
+        now = datetime.now()
+        one_week_ago = now - timedelta(days=7)
+        totals, _ = sum_rollups("hour", one_week_ago.replace(minute=0, second=0, microsecond=0))
+        
+        sentiments = {"Positive": 0, "Neutral": 0, "Negative": 0, "Very Negative": 0}
+        sentiments.update(totals["sentiment"])
+        priorities = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
+        priorities.update({int(p): count for p, count in totals["priority"].items()})
+        
+        report = {
+            "period": {
+                "start": one_week_ago.strftime("%Y-%m-%d"),
+                "end": now.strftime("%Y-%m-%d")
+            },
+            "total_emails": totals["total"],
+            "categories": {category: count for category, count in totals["category"].items() if count},
+            "sentiments": sentiments,
+            "priorities": priorities,
+            "languages": {language: count for language, count in totals["language"].items() if count},
+            "response_metrics": {
+                "avg_response_time": _average_hours(totals["response"])
+            },
+            "by_category": {}
+        }
+        
+        for category in list(DEPARTMENTS.keys()) + ["Unclassified"]:
+            statuses = totals["category_status"].get(category, {})
+            completed = statuses.get("resolved", 0)
+            pending = statuses.get("pending", 0) + statuses.get("in-progress", 0)
+            
+            report["by_category"][category] = {
+                "total": completed + pending,
+                "completed": completed,
+                "pending": pending
+            }
+            
+        return report
+    
+    except Exception as e:
+        print("Weekly Report Generation Error:", e)
+        return {}
+
+def get_response_statistics():
+    """Get statistics about response times and volumes from the rollups."""
+    if ANALYTICS_SOURCE != "rollups":
+        return get_response_statistics_live()
+    try:
+        now = datetime.now()
+        seven_days_ago = now - timedelta(days=7)
+        thirty_days_ago = now - timedelta(days=30)
+        categories = list(DEPARTMENTS.keys()) + ["Unclassified"]
+        
+        week, hourly_docs = sum_rollups("hour", seven_days_ago.replace(minute=0, second=0, microsecond=0))
+        month, _ = sum_rollups("day", thirty_days_ago.replace(hour=0, minute=0, second=0, microsecond=0))
+        
+        # Daily response counts for the last 7 days, in rolling 24h windows at hour granularity
+        daily = {}
+        for doc in hourly_docs:
+            day = int((now - doc["start"]).total_seconds() // 86400)
+            daily[day] = daily.get(day, 0) + doc.get("total", 0)
+        daily_counts = [{
+            "date": (now - timedelta(days=i+1)).strftime("%Y-%m-%d"),
+            "count": daily.get(i, 0)
+        } for i in range(7)]
+        
+        return {
+            "daily_counts": daily_counts,
+            "categories": {cat: month["category"].get(cat, 0) for cat in categories},
+            "priorities": {p: month["priority"].get(str(p), 0) for p in range(1, 6)},
+            "avg_response_times": {cat: _average_hours(month["category_response"].get(cat, {})) for cat in categories},
+            "total_responses": week["status"].get("resolved", 0)
+        }
+    except Exception as e:
+        print("Response Statistics Error:", e)
+        return {}
+
+def connect_mailbox():
+    """Open an authenticated IMAP session with the inbox selected."""
+    mail = IMAPClient(IMAP_HOST, ssl=True, timeout=60)
+    mail.login(EMAIL_USER, EMAIL_PASS)
+    mail.select_folder("INBOX")
+    return mail
+
+def format_uid_set(uids):
+    """Collapse UIDs into a compact IMAP sequence set such as "4:7,9"."""
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(first) if first == last else f"{first}:{last}" for first, last in ranges)
+
+def _to_text(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return value or ""
+
+def decode_mime_header(value):
+    """Decode an RFC 2047 encoded header value, joining every encoded word."""
+    value = _to_text(value)
+    if not value:
+        return ""
+    try:
+        return str(make_header(decode_header(value)))
+    except (LookupError, UnicodeDecodeError, ValueError):
+        # Unknown or broken charset: decode chunk by chunk and keep what we can
+        chunks = []
+        for decoded, encoding in decode_header(value):
+            if isinstance(decoded, bytes):
+                decoded = decode_charset(decoded, encoding)
+            chunks.append(decoded)
+        return "".join(chunks)
+
+def format_address(address):
+    """Format an ENVELOPE address as "Name <mailbox@host>"."""
+    mailbox = f"{_to_text(address.mailbox)}@{_to_text(address.host)}"
+    name = decode_mime_header(address.name)
+    return f"{name} <{mailbox}>" if name else mailbox
+
+def walk_body_structure(structure, number=""):
+    """Yield (part_number, part) for every leaf part of a BODYSTRUCTURE."""
+    if structure.is_multipart:
+        for index, part in enumerate(structure[0], start=1):
+            yield from walk_body_structure(part, f"{number}.{index}" if number else str(index))
+    else:
+        yield number or "1", structure
+
+def describe_part(part):
+    """Summarize a single-part BODYSTRUCTURE entry."""
+    params = part[2] or ()
+    params = {_to_text(params[i]).lower(): _to_text(params[i + 1]) for i in range(0, len(params) - 1, 2)}
+    
+    disposition, filename = "", params.get("name", "")
+    # The disposition's position among the extension fields depends on the media type
+    for field in part[7:]:
+        if isinstance(field, tuple) and field and isinstance(field[0], bytes) \
+                and field[0].lower() in (b"attachment", b"inline"):
+            disposition = _to_text(field[0]).lower()
+            disp_params = field[1] or ()
+            for i in range(0, len(disp_params) - 1, 2):
+                if _to_text(disp_params[i]).lower() == "filename":
+                    filename = _to_text(disp_params[i + 1])
+            break
+    
+    return {
+        "content_type": f"{_to_text(part[0])}/{_to_text(part[1])}".lower(),
+        "charset": params.get("charset", "utf-8"),
+        "encoding": _to_text(part[5]).lower(),
+        "size": part[6] or 0,
+        "disposition": disposition,
+        "filename": decode_mime_header(filename),
+    }
+
+def decode_transfer_encoding(payload, encoding):
+    """Undo the Content-Transfer-Encoding of a fetched part."""
+    if encoding == "base64":
+        return base64.b64decode(payload)
+    if encoding == "quoted-printable":
+        return quopri.decodestring(payload)
+    return payload
+
+def decode_charset(data, charset):
+    """Decode bytes with a declared charset, tolerating unknown or mislabelled ones."""
+    charset = (charset or "utf-8").strip().strip('"').lower()
+    charset = CHARSET_ALIASES.get(charset, charset)
+    try:
+        return data.decode(charset, errors="ignore")
+    except LookupError:
+        return data.decode("utf-8", errors="ignore")
+
+def decode_part_payload(payload, info):
+    """Decode a fetched, possibly truncated, text part to a string.
+
+    The part is fed in chunks to a BytesFeedParser behind a header rebuilt from
+    its BODYSTRUCTURE, which handles the transfer encoding and charset.
+    """
+    if info["encoding"] == "base64":
+        # Drop a partial base64 quantum left by the byte cap so the rest still decodes
+        payload = re.sub(rb"\s+", b"", payload)
+        payload = payload[:len(payload) - len(payload) % 4]
+    
+    parser = BytesFeedParser()
+    parser.feed(
+        f"Content-Type: {info['content_type']}; charset=\"{info['charset']}\"\r\n"
+        f"Content-Transfer-Encoding: {info['encoding'] or '7bit'}\r\n\r\n".encode()
+    )
+    for start in range(0, len(payload), 64 * 1024):
+        parser.feed(payload[start:start + 64 * 1024])
+    part = parser.close()
+    
+    text = decode_charset(part.get_payload(decode=True) or b"", part.get_content_charset())
+    if info["content_type"] == "text/html":
+        text = html_to_text(text)
+    return text
+
+class HTMLTextExtractor(HTMLParser):
+    """Collects the readable text of an HTML body, one line per block element."""
+    
+    BLOCK_TAGS = {"p", "div", "br", "tr", "li", "h1", "h2", "h3", "h4", "h5", "h6", "blockquote", "table", "hr"}
+    SKIP_TAGS = {"script", "style", "head", "title"}
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.chunks = []
+        self.skipping = 0
+    
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skipping += 1
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+    
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.chunks.append("\n")
+    
+    def handle_data(self, data):
+        if not self.skipping:
+            self.chunks.append(data)
+
+def html_to_text(html):
+    """Convert an HTML body to plain text for analysis."""
+    extractor = HTMLTextExtractor()
+    try:
+        extractor.feed(html)
+        extractor.close()
+    except Exception as e:
+        print("HTML Conversion Error:", e)
+    
+    lines = (re.sub(r"[ \t\r\f\v\xa0]+", " ", line).strip() for line in "".join(extractor.chunks).split("\n"))
+    return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+def fetch_message_batch(mail, uids):
+    """Fetch a batch of messages without downloading their attachments.
+
+    The first pass pulls ENVELOPE and BODYSTRUCTURE for the whole UID range; the
+    second pulls only the inline text parts of each message (text/plain, or
+    text/html converted to text when there is no plain part), grouped by part
+    number so every group is a single FETCH. Each part is read with a partial
+    fetch capped at IMAP_MAX_PART_BYTES, so memory per message stays bounded.
+    Attachments are recorded by part number and fetched later on demand.
+    """
+    overview = mail.fetch(format_uid_set(uids), [b"ENVELOPE", b"BODYSTRUCTURE", b"BODY.PEEK[HEADER.FIELDS (REFERENCES)]"])
+    
+    messages = {}
+    text_parts = {}
+    for uid, data in overview.items():
+        envelope = data[b"ENVELOPE"]
+        message = {
+            "uid": uid,
+            "uidvalidity": mailbox_state["uidvalidity"],
+            "subject": decode_mime_header(envelope.subject),
+            "sender": format_address(envelope.from_[0]) if envelope.from_ else "",
+            "message_id": _to_text(envelope.message_id),
+            "in_reply_to": _to_text(envelope.in_reply_to),
+            "references": parse_message_ids(data.get(b"BODY[HEADER.FIELDS (REFERENCES)]", b"")),
+            "body": "",
+            "attachments": [],
+        }
+        
+        plain_parts, html_parts = [], []
+        for number, part in walk_body_structure(data[b"BODYSTRUCTURE"]):
+            info = describe_part(part)
+            if info["content_type"] in ("text/plain", "text/html") and info["disposition"] != "attachment":
+                parts = plain_parts if info["content_type"] == "text/plain" else html_parts
+                if len(parts) < IMAP_MAX_TEXT_PARTS:
+                    parts.append((number, info))
+            elif info["disposition"] == "attachment" or not info["content_type"].startswith("text/"):
+                message["attachments"].append({
+                    "part": number,
+                    "filename": info["filename"],
+                    "content_type": info["content_type"],
+                    "encoding": info["encoding"],
+                    "size": info["size"],
+                })
+        messages[uid] = message
+        text_parts[uid] = plain_parts or html_parts
+    
+    by_part = {}
+    for uid, parts in text_parts.items():
+        for number, _ in parts:
+            by_part.setdefault(number, []).append(uid)
+    
+    bodies = {}
+    for number, part_uids in by_part.items():
+        fetched = mail.fetch(
+            format_uid_set(part_uids),
+            [f"BODY.PEEK[{number}]<0.{IMAP_MAX_PART_BYTES}>".encode()]
+        )
+        for uid, data in fetched.items():
+            payload = data.get(f"BODY[{number}]<0>".encode()) or data.get(f"BODY[{number}]".encode())
+            if uid in messages and payload:
+                bodies[(uid, number)] = payload
+    
+    for uid, parts in text_parts.items():
+        texts = []
+        for number, info in parts:
+            payload = bodies.pop((uid, number), None)
+            if payload:
+                texts.append(decode_part_payload(payload, info))
+        messages[uid]["body"] = "\n\n".join(text for text in texts if text.strip())
+        messages[uid]["normalized_body"] = normalize_body(messages[uid]["body"])
+    
+    return messages
+
+def fetch_attachment(email_doc, part):
+    """Download a single attachment of a stored email from the mailbox."""
+    attachment = next((a for a in email_doc.get('attachments', []) if a['part'] == part), None)
+    if not attachment or not email_doc.get('imap_uid'):
+        return None
+    
+    mail = connect_mailbox()
+    try:
+        uidvalidity = mail.folder_status("INBOX", [b"UIDVALIDITY"])[b"UIDVALIDITY"]
+        if uidvalidity != email_doc.get('imap_uidvalidity'):
+            print(f"Attachment unavailable: mailbox UIDVALIDITY changed for {email_doc.get('_id')}")
+            return None
+        
+        uid = email_doc['imap_uid']
+        data = mail.fetch([uid], [f"BODY.PEEK[{part}]".encode()]).get(uid)
+        if not data:
+            return None
+        
+        payload = decode_transfer_encoding(data[f"BODY[{part}]".encode()], attachment.get('encoding', ''))
+        return payload, attachment
+    finally:
+        close_mailbox(mail)
+
+# Each stage handler moves a job from QUEUE_STAGES[i] to QUEUE_STAGES[i + 1]
+QUEUE_STAGES = ["fetched", "analyzed", "forwarded", "replied", "stored"]
+
+def enqueue_messages(messages, fetch_span=None):
+    """Durably record fetched messages as jobs at the "fetched" stage.
+
+    Jobs are keyed by UIDVALIDITY and UID, so enqueueing a message twice (for
+    example after a crash before it was flagged \\Seen) is a no-op.
+    """
+    now = datetime.now()
+    jobs_collection.bulk_write([
+        UpdateOne(
+            {"_id": f"{message['uidvalidity']}:{message['uid']}"},
+            {"$setOnInsert": {
+                "stage": "fetched",
+                "status": "ready",
+                "attempts": 0,
+                "next_attempt_at": now,
+                "lease_until": None,
+                "lease_token": None,
+                "email_id": ObjectId(),
+                "trace_id": uuid.uuid4().hex,
+                "trace_spans": [fetch_span] if fetch_span else [],
+                "message": message,
+                "created_at": now,
+                "updated_at": now
+            }},
+            upsert=True
+        )
+        for message in messages
+    ], ordered=False)
+
+def claim_job(stage):
+    """Lease the next ready job waiting at a stage, or return None."""
+    now = datetime.now()
+    return jobs_collection.find_one_and_update(
+        {
+            "stage": stage,
+            "status": "ready",
+            "next_attempt_at": {"$lte": now},
+            "$or": [{"lease_until": None}, {"lease_until": {"$lt": now}}]
+        },
+        {"$set": {
+            "lease_until": now + timedelta(seconds=JOB_LEASE_SECONDS),
+            "lease_token": uuid.uuid4().hex
+        }},
+        sort=[("next_attempt_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def update_job(job, updates):
+    """Save progress on a leased job; returns False if the lease was lost."""
+    result = jobs_collection.update_one(
+        {"_id": job["_id"], "lease_token": job["lease_token"]},
+        {"$set": {**updates, "updated_at": datetime.now()}}
+    )
+    job.update(updates)
+    return result.matched_count == 1
+
+def renew_lease(job):
+    """Extend a job's lease; returns False if another worker has taken it over."""
+    result = jobs_collection.update_one(
+        {"_id": job["_id"], "lease_token": job["lease_token"]},
+        {"$set": {"lease_until": datetime.now() + timedelta(seconds=JOB_LEASE_SECONDS)}}
+    )
+    return result.matched_count == 1
+
+@contextmanager
+def lease_heartbeat(job):
+    """Keep renewing a job's lease while its stage runs, however long Gemini or SMTP take."""
+    stop = threading.Event()
+    
+    def renew():
+        while not stop.wait(JOB_LEASE_SECONDS / 3):
+            try:
+                if not renew_lease(job):
+                    print(f"Job {job['_id']} lost its lease at stage '{job['stage']}'")
+                    return
+            except Exception as e:
+                print("Lease Renewal Error:", e)
+    
+    thread = threading.Thread(target=renew, daemon=True, name=f"lease-{job['_id']}")
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def complete_stage(job, updates, spans=()):
+    """Advance a job to the next stage, append the stage's spans and release its lease.
+
+    Returns False without touching the stored email if the lease was lost, since
+    the worker that took the job over will complete the stage itself.
+    """
+    next_stage = QUEUE_STAGES[QUEUE_STAGES.index(job["stage"]) + 1]
+    trace_spans = job.get("trace_spans", []) + list(spans)
+    if not update_job(job, {
+        **updates,
+        "stage": next_stage,
+        "status": "done" if next_stage == QUEUE_STAGES[-1] else "ready",
+        "attempts": 0,
+        "next_attempt_at": datetime.now(),
+        "lease_until": None,
+        "lease_token": None,
+        "last_error": None,
+        "trace_spans": trace_spans
+    }):
         return False
+    if next_stage == QUEUE_STAGES[-1]:
+        # The email was stored during this stage; give it the finished trace
+        emails_collection.update_one({"_id": job["email_id"]}, {"$set": {"trace.spans": trace_spans}})
+        # The stored email now owns the body and trace, so the job drops its copies
+        jobs_collection.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"completed_at": datetime.now()},
+             "$unset": {"message.body": "", "message.normalized_body": "", "trace_spans": ""}}
+        )
+    return True
+
+def fail_job(job, error, spans=()):
+    """Schedule a retry with exponential backoff, or dead-letter the job."""
+    attempts = job.get("attempts", 0) + 1
+    updates = {
+        "attempts": attempts,
+        "last_error": f"{job['stage']}: {error}",
+        "lease_until": None,
+        "lease_token": None,
+        "trace_spans": job.get("trace_spans", []) + list(spans)
+    }
+    if attempts >= JOB_MAX_ATTEMPTS:
+        print(f"Job {job['_id']} dead-lettered at stage '{job['stage']}': {error}")
+        updates.update({"status": "dead", "dead_at": datetime.now()})
+    else:
+        delay = min(JOB_RETRY_BASE_DELAY * 2 ** (attempts - 1), JOB_RETRY_MAX_DELAY)
+        updates["next_attempt_at"] = datetime.now() + timedelta(seconds=delay)
+    jobs_collection.update_one({"_id": job["_id"], "lease_token": job["lease_token"]}, {"$set": updates})
+
+def department_email(category):
+    to_email = DEPARTMENTS.get(category)
+    if not to_email:
+        print(f"Warning: No email configured for category '{category}'. Using general email.")
+        to_email = os.getenv("GENERAL_EMAIL", EMAIL_USER)
+    return to_email
+
+def analyze_job(job):
+    message = job["message"]
+    # Fall back to the default labels on the last attempt rather than dead-lettering
+    final_attempt = job.get("attempts", 0) >= JOB_MAX_ATTEMPTS - 1
+    body = message.get("normalized_body") or normalize_body(message["body"])
+    if DUPLICATE_DETECTION:
+        analysis, cluster = analyze_with_clusters(job, message, body, raise_errors=not final_attempt)
+    else:
+        analysis, cluster = analyze_email(message["subject"], body, raise_errors=not final_attempt,
+                                          raw_body=message["body"]), {}
+    
+    to_email = department_email(analysis["category"])
+    return {"analysis": analysis, "to_email": to_email, "thread_key": resolve_thread_key(message), **cluster}
+
+def forward_job(job):
+    message, analysis, to_email = job["message"], job["analysis"], job["to_email"]
+    if job.get("cluster_member"):
+        # Departments get one notice per cluster threshold instead of every near-duplicate
+        if job["cluster_count"] in DUPLICATE_NOTICE_THRESHOLDS:
+            cluster = clusters_collection.find_one({"_id": job["cluster_id"]})
+            if cluster and not forward_cluster_notice(cluster, to_email):
+                raise RuntimeError(f"could not send cluster notice to {to_email}")
+        return {}
+    
+    print(f"Attempting to forward as '{analysis['category']}' to {to_email}")
+    if not forward_email(message["subject"], message["body"], to_email, message["sender"], analysis):
+        raise RuntimeError(f"could not forward to {to_email}")
+    print(f"Successfully forwarded '{message['subject']}' to {to_email} (Category: {analysis['category']})")
+    return {}
+
+def reply_job(job):
+    """Store the drafted reply and send it to the customer when eligible."""
+    message, analysis = job["message"], job["analysis"]
+    auto_response = analysis.get("auto_response")
+    if not auto_response:
+        return {}
+    
+    # Record progress so a retry after a failed send does not store the reply twice
+    if not job.get("reply_stored"):
+        if not store_auto_response(message["sender"], message["subject"], auto_response, analysis["category"],
+                                   email_id=job["email_id"]):
+            raise RuntimeError("could not store auto-response")
+        if not update_job(job, {"reply_stored": True}):
+            raise RuntimeError("lost the job lease before sending the auto-response")
+    
+    if is_auto_reply_eligible(analysis["category"], analysis["priority"]):
+        headers = reply_headers(message.get("message_id"), message.get("references", []))
+        if not send_auto_response(message["sender"], auto_response, message["subject"], headers):
+            raise RuntimeError(f"could not send auto-response to {message['sender']}")
+        record_conversation_reply(job.get("thread_key"), headers["Message-ID"], message["subject"])
+    return {}
+
+def store_job(job):
+    message, analysis = job["message"], job["analysis"]
+    thread_key = job.get("thread_key") or resolve_thread_key(message)
+    stored = store_email(analysis["category"], message["sender"], message["subject"], message["body"],
+                         job["to_email"], analysis, metadata={
+                             "_id": job["email_id"],
+                             "message_id": message["message_id"],
+                             "in_reply_to": message.get("in_reply_to"),
+                             "references": message.get("references", []),
+                             "thread_key": thread_key,
+                             "cluster_id": job.get("cluster_id"),
+                             "normalized_body": message.get("normalized_body") or normalize_body(message["body"]),
+                             "imap_uid": message["uid"],
+                             "imap_uidvalidity": message["uidvalidity"],
+                             "attachments": message["attachments"],
+                             "trace": {"trace_id": job.get("trace_id"), "spans": job.get("trace_spans", [])},
+                         })
+    if not stored:
+        raise RuntimeError("could not store email")
+    record_conversation_email(thread_key, job["email_id"], message)
+    return {}
+
+STAGE_HANDLERS = {
+    "fetched": analyze_job,
+    "analyzed": forward_job,
+    "forwarded": reply_job,
+    "replied": store_job,
+}
+
+def run_stage_worker(stage):
+    """Drain jobs waiting at one stage of the pipeline."""
+    handler = STAGE_HANDLERS[stage]
+    step = handler.__name__.removesuffix("_job")
+    while True:
+        job = None
+        spans = []
+        if not runs_queue_jobs():
+            time.sleep(QUEUE_IDLE_SLEEP)
+            continue
+        try:
+            job = claim_job(stage)
+            if not job:
+                time.sleep(QUEUE_IDLE_SLEEP)
+                continue
+            with collect_spans(spans), QUEUE_STAGE_SECONDS.time(stage=step), trace_span(step), lease_heartbeat(job):
+                updates = handler(job)
+            if complete_stage(job, updates, spans):
+                QUEUE_JOBS_PROCESSED.inc(stage=step, outcome="completed")
+            else:
+                print(f"Job {job['_id']} lost its lease during '{stage}'; leaving it to its new owner")
+                QUEUE_JOBS_PROCESSED.inc(stage=step, outcome="lease_lost")
+        except Exception as e:
+            print(f"Queue Worker Error ({stage}, trace {job.get('trace_id') if job else None}):", e)
+            if job:
+                QUEUE_JOBS_PROCESSED.inc(stage=step, outcome="failed")
+                try:
+                    fail_job(job, e, spans)
+                except Exception as fail_error:
+                    print("Job Retry Scheduling Error:", fail_error)
+            else:
+                time.sleep(QUEUE_IDLE_SLEEP)
+
+def start_queue_workers():
+    for stage, workers in STAGE_WORKERS.items():
+        for i in range(workers):
+            threading.Thread(target=run_stage_worker, args=(stage,), daemon=True,
+                             name=f"queue-{stage}-{i}").start()
+
+def get_queue_stats():
+    """Count jobs per stage and status."""
+    stats = {"ready": {}, "dead": {}, "done": 0}
+    for doc in jobs_collection.aggregate([
+        {"$group": {"_id": {"stage": "$stage", "status": "$status"}, "count": {"$sum": 1}}}
+    ]):
+        stage, status = doc["_id"].get("stage"), doc["_id"].get("status")
+        if status == "done":
+            stats["done"] += doc["count"]
+        else:
+            stats.setdefault(status, {})[stage] = doc["count"]
+    return stats
+
+def get_dead_letters(limit=10):
+    """Dead-lettered jobs, most recent first, with the email they were carrying."""
+    jobs = jobs_collection.find(
+        {"status": "dead"},
+        {"email_id": 1, "stage": 1, "last_error": 1, "attempts": 1, "dead_at": 1,
+         "message.subject": 1, "message.sender": 1}
+    ).sort("dead_at", DESCENDING).limit(limit)
+    return [{
+        "email_id": str(job["email_id"]),
+        "subject": job.get("message", {}).get("subject", ""),
+        "sender": job.get("message", {}).get("sender", ""),
+        "stage": job.get("stage"),
+        "last_error": job.get("last_error", ""),
+        "dead_at": job.get("dead_at"),
+    } for job in jobs]
+
+def requeue_dead_jobs(email_id=None):
+    """Give dead-lettered jobs a fresh set of attempts at the stage where they stopped."""
+    query = {"status": "dead"}
+    if email_id:
+        query["email_id"] = email_id
+    result = jobs_collection.update_many(
+        query,
+        {"$set": {"status": "ready", "attempts": 0, "next_attempt_at": datetime.now(),
+                  "lease_until": None, "lease_token": None}}
+    )
+    return result.modified_count
+
+@bp.cli.command("requeue-dead-jobs")
+def requeue_dead_jobs_command():
+    """Retry every dead-lettered job."""
+    print(f"Requeued {requeue_dead_jobs()} job(s)")
+
+def find_new_uids(mail):
+    """Return the UIDs of unseen messages that arrived since the last check.
+
+    Uses UIDNEXT to skip the search entirely when nothing has arrived, and falls
+    back to a full UNSEEN search on first run or when UIDVALIDITY changes.
+    """
+    status = mail.folder_status("INBOX", [b"UIDNEXT", b"UIDVALIDITY"])
+    uidvalidity, uidnext = status[b"UIDVALIDITY"], status[b"UIDNEXT"]
+    
+    if uidvalidity != mailbox_state["uidvalidity"]:
+        mailbox_state["uidvalidity"] = uidvalidity
+        mailbox_state["uidnext"] = None
+        mailbox_state["retry_uids"].clear()
+    
+    last_uidnext = mailbox_state["uidnext"]
+    retry_uids = mailbox_state["retry_uids"]
+    
+    if last_uidnext is None:
+        uids = mail.search(["UNSEEN"])
+    elif uidnext == last_uidnext and not retry_uids:
+        uids = []
+    else:
+        uid_set = ",".join([str(uid) for uid in sorted(retry_uids)] + [f"{last_uidnext}:*"])
+        # "n:*" always matches the highest UID, so drop anything older that we did not ask for
+        uids = [uid for uid in mail.search(["UNSEEN", "UID", uid_set])
+                if uid >= last_uidnext or uid in retry_uids]
+    
+    mailbox_state["uidnext"] = uidnext
+    return sorted(uids)
+
+def mark_seen(mail, uids):
+    """Flag messages as seen with a single STORE command."""
+    if uids:
+        mail.add_flags(format_uid_set(uids), [SEEN])
+
+def process_new_messages(mail):
+    """Fetch new unseen messages in batches and hand them to the job queue.
+
+    A message is flagged \\Seen as soon as its job is durably stored; the stage
+    workers take it from there.
+    """
+    uids = find_new_uids(mail)
+    if not uids:
+        return
+    
+    print(f"Found {len(uids)} unread email(s)")
+    
+    queued_count = 0
+    for start in range(0, len(uids), IMAP_FETCH_BATCH):
+        batch = uids[start:start + IMAP_FETCH_BATCH]
+        try:
+            fetch_span = {"name": "imap_fetch", "start": datetime.now(), "depth": 0}
+            started = time.monotonic()
+            messages = fetch_message_batch(mail, batch)
+            IMAP_FETCH_SECONDS.observe(time.monotonic() - started)
+            fetch_span["duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+            if messages:
+                enqueue_messages(list(messages.values()), fetch_span)
+            mark_seen(mail, list(messages))
+        except Exception:
+            # Try these UIDs again after reconnecting
+            mailbox_state["retry_uids"].update(batch)
+            raise
+        mailbox_state["retry_uids"].difference_update(batch)
+        queued_count += len(messages)
+        EMAILS_FETCHED.inc(len(messages))
+        
+    print(f"Queued {queued_count}/{len(uids)} unread email(s)")
+
+def wait_for_new_mail(mail):
+    """Block until the server pushes new mail (IDLE) or the poll interval passes."""
+    if IMAP_MODE != "idle" or not mail.has_capability("IDLE"):
+        time.sleep(POLL_INTERVAL)
+        return
+    
+    mail.idle()
+    try:
+        deadline = time.monotonic() + IMAP_IDLE_TIMEOUT
+        # Wake up every POLL_INTERVAL so pausing takes effect without waiting for mail
+        while time.monotonic() < deadline and should_poll():
+            responses = mail.idle_check(timeout=POLL_INTERVAL)
+            if any(len(response) > 1 and response[1] == b"EXISTS" for response in responses):
+                return
+    finally:
+        mail.idle_done()
+
+def is_polling_active():
+    """Read the cluster-wide polling switch, refreshed from MongoDB every few seconds."""
+    now = time.monotonic()
+    if now - polling_state["checked_at"] >= POLLING_STATE_REFRESH:
+        try:
+            setting = settings_collection.find_one({"_id": "polling"})
+            polling_state.update(active=bool(setting and setting.get("active")), checked_at=now)
+        except Exception as e:
+            print("Polling State Error:", e)
+    return polling_state["active"]
+
+def set_polling_active(active):
+    """Persist the polling switch so every process sees the same state."""
+    settings_collection.update_one(
+        {"_id": "polling"},
+        {"$set": {"active": active, "updated_at": datetime.now()}},
+        upsert=True
+    )
+    polling_state.update(active=active, checked_at=time.monotonic())
+
+def poller_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
 
-def store_email(category, sender, subject, body, forwarded_to=None):
-    try:
-        sentiment = analyze_sentiment(body)
-        language = detect_language(body)
-        summary = summarize_email(body) if len(body.split()) > 100 else ""
-        customer_id = extract_customer_id(body)
-        priority = calculate_priority(subject, body, sentiment)
-        
-        email_doc = {
-            "category": category,
-            "sender": sender,
-            "subject": subject,
-            "body": body,
-            "summary": summary,
-            "forwarded_to": forwarded_to,
-            "sentiment": sentiment,
-            "priority": priority,
-            "language": language,
-            "customer_id": customer_id,
-            "response_time": None,
-            "status": "pending",
-            "timestamp": datetime.now()
-        }
-        emails_collection.insert_one(email_doc)
-        return True
-    except Exception as e:
-        print("Database Error:", e)
-        return False
+def acquire_poller_lease():
+    """Take or renew the lease that makes this process the only mailbox poller.
 
-def store_auto_response(recipient, subject, response_text, category, is_auto=True):
-    """Store auto-generated responses in the database."""
+    The lease document is matched only if this process already owns it or it has
+    expired; otherwise the upsert collides on _id and another process stays leader.
+    """
+    now = datetime.now()
     try:
-        response_doc = {
-            "recipient": recipient,
-            "subject": subject,
-            "response_text": response_text,
-            "category": category,
-            "is_auto": is_auto,
-            "timestamp": datetime.now()
-        }
-        responses_collection.insert_one(response_doc)
+        renewed = time.monotonic()
+        locks_collection.update_one(
+            {"_id": "poller", "$or": [{"owner": poller_owner()}, {"expires_at": {"$lt": now}}]},
+            {"$set": {
+                "owner": poller_owner(),
+                "expires_at": now + timedelta(seconds=POLLER_LEASE_SECONDS),
+                "renewed_at": now
+            }},
+            upsert=True
+        )
+        poller_lease_state["held_until"] = renewed + POLLER_LEASE_SECONDS
         return True
-    except Exception as e:
-        print("Response Storage Error:", e)
+    except DuplicateKeyError:
+        poller_lease_state["held_until"] = float("-inf")
         return False
 
-def get_emails_by_category():
+def holds_poller_lease():
+    """Whether this process renewed the poller lease recently enough to still own it."""
+    return time.monotonic() < poller_lease_state["held_until"]
+
+def runs_queue_jobs():
+    return QUEUE_WORKERS_ON == "all" or holds_poller_lease()
+
+def release_poller_lease():
+    poller_lease_state["held_until"] = float("-inf")
     try:
-        email_data = {
-            "Technical": [],
-            "Billing": [],
-            "Complaint": [],
-            "General Inquiry": [],
-            "Unclassified": []
-        }
-        
-        emails = emails_collection.find().sort("timestamp", -1)
-        
-        for email_doc in emails:
-            category = email_doc['category']
-            email_data.setdefault(category, []).append({
-                "_id": str(email_doc['_id']),  # Convert ObjectId to string to make it accessible in templates
-                "from": email_doc['sender'],
-                "subject": email_doc['subject'],
-                "body": email_doc['body'],
-                "summary": email_doc.get('summary', ''),
-                "sentiment": email_doc.get('sentiment', 'Neutral'),
-                "priority": email_doc.get('priority', 3),
-                "language": email_doc.get('language', 'en'),
-                "customer_id": email_doc.get('customer_id', ''),
-                "forwarded_to": email_doc.get('forwarded_to', 'Not recorded'),
-                "timestamp": email_doc['timestamp'],
-                "status": email_doc.get('status', 'pending')
-            })
-            
-        return email_data
+        locks_collection.delete_one({"_id": "poller", "owner": poller_owner()})
     except Exception as e:
-        print("Database Read Error:", e)
-        return {"Technical": [], "Billing": [], "Complaint": [], "General Inquiry": [], "Unclassified": []}
+        print("Poller Lease Release Error:", e)
 
-def generate_weekly_report():
-    """Generate a weekly analytics report."""
+def should_poll():
+    return is_polling_active() and acquire_poller_lease()
+
+def close_mailbox(mail):
     try:
-        one_week_ago = datetime.now() - timedelta(days=7)
-        emails = emails_collection.find({"timestamp": {"$gte": one_week_ago}})
-        
-        total_emails = 0
-        categories = {}
-        sentiments = {"Positive": 0, "Neutral": 0, "Negative": 0, "Very Negative": 0}
-        priorities = {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-        languages = {}
-        response_times = []
-        
-        for email in emails:
-            total_emails += 1
-            
-            category = email.get('category', 'Unclassified')
-            categories[category] = categories.get(category, 0) + 1
-            
-            sentiment = email.get('sentiment', 'Neutral')
-            sentiments[sentiment] = sentiments.get(sentiment, 0) + 1
+        mail.logout()
+    except Exception:
+        pass
+
+def fetch_and_process_emails():
+    """Hold one IMAP session and process mail as it arrives.
+
+    Waits with IDLE when the server supports it, otherwise polls incrementally by
+    UID. Reconnects with exponential backoff after errors, including MongoDB errors
+    while renewing the lease. Every process may run this loop; only the holder of
+    the poller lease touches the mailbox. The lease is kept while polling is
+    paused, so the leader goes on draining the queue.
+    """
+    mail = None
+    backoff = 1
+    while True:
+        try:
+            if not acquire_poller_lease():
+                if mail:
+                    close_mailbox(mail)
+                    mail = None
+                time.sleep(POLL_INTERVAL)
+                continue
             
-            priority = email.get('priority', 3)
-            priorities[priority] = priorities.get(priority, 0) + 1
+            if not is_polling_active():  # Only fetch emails if polling is active
+                if mail:
+                    close_mailbox(mail)
+                    mail = None
+                print("Email polling is paused")
+                time.sleep(POLL_INTERVAL)
+                continue
             
-            language = email.get('language', 'en')
-            languages[language] = languages.get(language, 0) + 1
+            if mail is None:
+                mail = connect_mailbox()
+                print(f"Connected to {IMAP_HOST} ({'IDLE' if IMAP_MODE == 'idle' and mail.has_capability('IDLE') else 'polling'} mode)")
             
-            if email.get('status') == 'resolved' and email.get('response_time'):
-                response_duration = email.get('response_time') - email.get('timestamp')
-                response_times.append(response_duration.total_seconds() / 3600)
+            process_new_messages(mail)
+            backoff = 1
+            wait_for_new_mail(mail)
+        except Exception as e:
+            print("Polling Error:", e)
+            if mail:
+                close_mailbox(mail)
+                mail = None
+            print(f"Reconnecting in {backoff}s")
+            time.sleep(backoff)
+            backoff = min(backoff * 2, IMAP_MAX_BACKOFF)
+
+def ensure_indexes():
+    """Create every index in INDEX_SPECS; indexes that already exist are left as they are."""
+    for collection_name, keys, options in INDEX_SPECS:
+        try:
+            db[collection_name].create_index(keys, **options)
+        except Exception as e:
+            print(f"Index Creation Error ({collection_name}.{options['name']}):", e)
+
+def index_key(keys, weights=None):
+    """Comparable form of an index's keys; text indexes are stored as _fts/_ftsx plus weights."""
+    if weights:
+        return tuple(sorted((field, TEXT) for field in weights))
+    if any(direction == TEXT for _, direction in keys):
+        return tuple(sorted((field, TEXT) for field, direction in keys if direction == TEXT))
+    return tuple(tuple(key) for key in keys)
+
+def check_indexes():
+    """Compare INDEX_SPECS against the database.
+
+    Returns the expected indexes that are missing, indexes that exist but are
+    not part of INDEX_SPECS, and indexes with no recorded use since the server
+    last started (from $indexStats).
+    """
+    report = {"missing": [], "unexpected": [], "unused": []}
+    collections = sorted({collection_name for collection_name, _, _ in INDEX_SPECS})
+    
+    for collection_name in collections:
+        expected = {index_key(keys): options["name"] for name, keys, options in INDEX_SPECS if name == collection_name}
+        existing = {name: index_key(info["key"], info.get("weights"))
+                    for name, info in db[collection_name].index_information().items()}
         
-        avg_response_time = sum(response_times) / len(response_times) if response_times else 0
-                
-        report = {
-            "period": {
-                "start": one_week_ago.strftime("%Y-%m-%d"),
-                "end": datetime.now().strftime("%Y-%m-%d")
-            },
-            "total_emails": total_emails,
-            "categories": categories,
-            "sentiments": sentiments,
-            "priorities": priorities,
-            "languages": languages,
-            "response_metrics": {
-                "avg_response_time": avg_response_time
-            },
-            "by_category": {}
-        }
+        for keys, name in expected.items():
+            if keys not in existing.values():
+                report["missing"].append(f"{collection_name}.{name}")
+        for name, keys in existing.items():
+            if name != "_id_" and keys not in expected:
+                report["unexpected"].append(f"{collection_name}.{name}")
         
-        # Get category stats
-        for category in list(DEPARTMENTS.keys()) + ["Unclassified"]:
-            completed = emails_collection.count_documents({
-                "category": category,
-                "status": "resolved",
-                "timestamp": {"$gte": one_week_ago}
-            })
-            
-            pending = emails_collection.count_documents({
-                "category": category,
-                "status": {"$in": ["pending", "in-progress"]},
-                "timestamp": {"$gte": one_week_ago}
-            })
-            
-            report["by_category"][category] = {
-                "total": completed + pending,
-                "completed": completed,
-                "pending": pending
-            }
-            
-        return report
+        try:
+            for stats in db[collection_name].aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                    report["unused"].append(f"{collection_name}.{stats['name']}")
+        except Exception as e:
+            print(f"Index Stats Error ({collection_name}):", e)
     
-    except Exception as e:
-        print("Weekly Report Generation Error:", e)
-        return {}
+    return report
 
-def get_response_statistics():
-    """Get statistics about response times and volumes."""
-    try:
-        now = datetime.now()
-        seven_days_ago = now - timedelta(days=7)
-        thirty_days_ago = now - timedelta(days=30)
-        
-        # Daily response counts for the last 7 days
-        daily_counts = []
-        for i in range(7):
-            day_start = now - timedelta(days=i+1)
-            day_end = now - timedelta(days=i)
-            count = emails_collection.count_documents({
-                "timestamp": {"$gte": day_start, "$lt": day_end}
-            })
-            daily_counts.append({
-                "date": day_start.strftime("%Y-%m-%d"),
-                "count": count
-            })
-        
-        # Category distribution
-        categories = {}
-        for cat in list(DEPARTMENTS.keys()) + ["Unclassified"]:
-            categories[cat] = emails_collection.count_documents({
-                "category": cat,
-                "timestamp": {"$gte": thirty_days_ago}
-            })
-        
-        # Priority distribution
-        priorities = {}
-        for p in range(1, 6):
-            priorities[p] = emails_collection.count_documents({
-                "priority": p,
-                "timestamp": {"$gte": thirty_days_ago}
-            })
-        
-        # Average response times by category
-        avg_times = {}
-        for cat in list(DEPARTMENTS.keys()) + ["Unclassified"]:
-            emails = emails_collection.find({
-                "category": cat,
-                "status": "resolved",
-                "timestamp": {"$gte": thirty_days_ago},
-                "response_time": {"$ne": None}
-            })
-            
-            times = []
-            for email in emails:
-                response_duration = email.get('response_time') - email.get('timestamp')
-                times.append(response_duration.total_seconds() / 3600)
-            
-            avg_times[cat] = sum(times) / len(times) if times else 0
-            
-        # Count total responses
-        total_responses = emails_collection.count_documents({
-            "status": "resolved",
-            "timestamp": {"$gte": seven_days_ago}
-        })
-        
-        return {
-            "daily_counts": daily_counts,
-            "categories": categories,
-            "priorities": priorities,
-            "avg_response_times": avg_times,
-            "total_responses": total_responses
-        }
-    except Exception as e:
-        print("Response Statistics Error:", e)
-        return {}
+@bp.cli.command("init-indexes")
+def init_indexes_command():
+    """Create the indexes used by the dashboard and analytics queries."""
+    ensure_indexes()
+    report = check_indexes()
+    print("Missing indexes:", ", ".join(report["missing"]) or "none")
 
-def fetch_and_process_emails():
-    global polling_active
+@bp.cli.command("check-indexes")
+def check_indexes_command():
+    """Report missing, unexpected and unused indexes."""
+    report = check_indexes()
+    for kind in ("missing", "unexpected", "unused"):
+        print(f"{kind.capitalize()} indexes:", ", ".join(report[kind]) or "none")
+
+def archive_documents(source, target, query, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move the documents matching a query from a hot collection to its archive.
+
+    Each batch is copied before the originals are deleted, so an interrupted run
+    leaves documents in both collections rather than in neither; running it again
+    finishes the move.
+    """
+    moved = 0
     while True:
-        if polling_active:  # Only fetch emails if polling is active
-            try:
-                mail = imaplib.IMAP4_SSL("imap.gmail.com")
-                mail.login(EMAIL_USER, EMAIL_PASS)
-                mail.select("inbox")
+        batch = list(source.find(query).limit(batch_size))
+        if not batch:
+            return moved
+        target.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch], ordered=False)
+        source.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        moved += len(batch)
 
-                _, messages = mail.search(None, "UNSEEN")
-                email_ids = messages[0].split()
-                
-                print(f"Found {len(email_ids)} unread email(s)")
-                
-                processed_count = 0
-
-                for eid in email_ids:
-                    _, msg_data = mail.fetch(eid, "(RFC822)")
-                    msg = email.message_from_bytes(msg_data[0][1])
-
-                    subject, encoding = decode_header(msg["Subject"])[0]
-                    if isinstance(subject, bytes):
-                        subject = subject.decode(encoding or "utf-8")
-                    sender = msg.get("From")
-
-                    body = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            if part.get_content_type() == "text/plain":
-                                body = part.get_payload(decode=True).decode(errors="ignore")
-                                break
-                    else:
-                        body = msg.get_payload(decode=True).decode(errors="ignore")
-
-                    category = classify_email(body)
-                    
-                    to_email = DEPARTMENTS.get(category)
-                    if not to_email:
-                        print(f"Warning: No email configured for category '{category}'. Using general email.")
-                        to_email = os.getenv("GENERAL_EMAIL", EMAIL_USER)
-                    
-                    print(f"Attempting to forward as '{category}' to {to_email}")
-                    forward_result = forward_email(subject, body, to_email, sender)
-                    
-                    if forward_result:
-                        print(f"Successfully forwarded '{subject}' to {to_email} (Category: {category})")
-                    else:
-                        print(f"Failed to forward '{subject}' to {to_email} (Category: {category})")
-
-                    store_email(category, sender, subject, body, to_email)
-
-                    mail.store(eid, '+FLAGS', '\\Seen')
-                    
-                    processed_count += 1
-                    
-                print(f"Successfully processed {processed_count}/{len(email_ids)} unread email(s)")
-                
-                mail.logout()
-            except Exception as e:
-                print("Polling Error:", e)
-        else:
-            print("Email polling is paused")
+def archive_old_emails(days=ARCHIVE_AFTER_DAYS):
+    """Move emails and responses older than `days` to the archive collections.
+
+    Bodies stay in the blob store and the analytics rollups keep counting the
+    archived emails; email details still find them, but the dashboard lists and
+    search only cover the hot collection.
+    """
+    cutoff = datetime.now() - timedelta(days=days)
+    emails = archive_documents(emails_collection, emails_archive_collection, {"timestamp": {"$lt": cutoff}})
+    responses = archive_documents(responses_collection, responses_archive_collection, {"timestamp": {"$lt": cutoff}})
+    return emails, responses
+
+def restore_archived_email(email_id):
+    """Move an archived email and its responses back to the hot collections so it can be updated again."""
+    email = emails_archive_collection.find_one({"_id": email_id})
+    if not email:
+        return False
+    # Copied before the archived documents are deleted, as in archive_documents
+    emails_collection.replace_one({"_id": email_id}, email, upsert=True)
+    for response in responses_archive_collection.find({"email_id": email_id}):
+        responses_collection.replace_one({"_id": response["_id"]}, response, upsert=True)
+    responses_archive_collection.delete_many({"email_id": email_id})
+    emails_archive_collection.delete_one({"_id": email_id})
+    return True
+
+@bp.cli.command("archive-emails")
+def archive_emails_command():
+    """Move emails and responses older than ARCHIVE_AFTER_DAYS out of the hot collections."""
+    emails, responses = archive_old_emails()
+    print(f"Archived {emails} email(s) and {responses} response(s) older than {ARCHIVE_AFTER_DAYS} day(s)")
+
+def migrate_cold_storage(batch_size=ARCHIVE_BATCH_SIZE):
+    """Move the inline bodies of emails and responses stored before the blob store existed.
+
+    Also gives those emails their search_terms and replaces a text index built
+    over the old body field.
+    """
+    migrated = 0
+    for collection, fields in ((emails_collection, ["body", "normalized_body"]), (responses_collection, ["response_text"])):
+        query = {"cold_fields": {"$exists": False}, "$or": [{field: {"$exists": True}} for field in fields]}
+        last_id = None
+        while True:
+            page = {**query, "_id": {"$gt": last_id}} if last_id else query
+            batch = list(collection.find(page).sort("_id", ASCENDING).limit(batch_size))
+            if not batch:
+                break
+            last_id = batch[-1]["_id"]
+            
+            blobs, updates = [], []
+            for doc in batch:
+                hot = {}
+                if collection is emails_collection:
+                    hot["search_terms"] = search_terms(doc.get("normalized_body") or normalize_body(doc.get("body", "")))
+                blob = split_cold_fields(doc, fields)
+                if blob:
+                    blobs.append(blob)
+                    hot["cold_fields"] = doc["cold_fields"]
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": hot, "$unset": {field: "" for field in doc["cold_fields"]}}))
+                elif hot:
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": hot}))
+            if blobs:
+                blobs_collection.bulk_write(blobs, ordered=False)
+            if updates:
+                collection.bulk_write(updates, ordered=False)
+            migrated += len(blobs)
+    
+    text_index = emails_collection.index_information().get("email_text_search")
+    if text_index and "search_terms" not in text_index.get("weights", {}):
+        emails_collection.drop_index("email_text_search")
+    ensure_indexes()
+    return migrated
+
+@bp.cli.command("migrate-cold-storage")
+def migrate_cold_storage_command():
+    """Move inline bodies into the compressed blob store and rebuild the search index."""
+    print(f"Moved the bodies of {migrate_cold_storage()} document(s) to the blob store")
+
+def start_background_processing():
+    """Start the mailbox poller and the queue workers on background threads.
+
+    Nothing is started on import; this is called by flask run-poller, the
+    development server and each gunicorn worker. The poller lease lets only one
+    process read the mailbox, and with QUEUE_WORKERS_ON=leader only that process
+    runs queue jobs; the other processes' workers wait to take over.
+    """
+    if os.getenv("AUTO_CREATE_INDEXES", "true").lower() == "true":
+        ensure_indexes()
+    start_queue_workers()
+    threading.Thread(target=fetch_and_process_emails, daemon=True, name="imap-poller").start()
+    atexit.register(release_poller_lease)
+
+@bp.cli.command("run-poller")
+def run_poller_command():
+    """Poll the mailbox and run the queue workers until interrupted."""
+    start_background_processing()
+    while True:
+        time.sleep(3600)
 
-        time.sleep(30)
+def format_trace(trace):
+    """Lay out a stored trace as a waterfall: spans in start order with offsets from the first one."""
+    if not trace or not trace.get('spans'):
+        return None
+    
+    spans = sorted(trace['spans'], key=lambda span: span['start'])
+    origin = spans[0]['start']
+    waterfall = []
+    for span in spans:
+        waterfall.append({
+            "name": span['name'],
+            "start": span['start'].strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            "offset_ms": round((span['start'] - origin).total_seconds() * 1000, 1),
+            "duration_ms": span.get('duration_ms', 0),
+            "depth": span.get('depth', 0),
+            "error": span.get('error'),
+        })
+    
+    total_ms = max(span['offset_ms'] + span['duration_ms'] for span in waterfall)
+    return {"trace_id": trace.get('trace_id'), "total_ms": total_ms, "spans": waterfall}
 
-threading.Thread(target=fetch_and_process_emails, daemon=True).start()
+def dead_letter_email(job):
+    """An email document built from a dead-lettered job, which never reached the store stage."""
+    message, analysis = job.get("message", {}), job.get("analysis", {})
+    return {
+        "_id": job["email_id"],
+        "category": analysis.get("category", "Unclassified"),
+        "sender": message.get("sender", ""),
+        "subject": message.get("subject", ""),
+        "body": message.get("body", ""),
+        "summary": analysis.get("summary", ""),
+        "sentiment": analysis.get("sentiment", "Neutral"),
+        "priority": analysis.get("priority", 3),
+        "language": analysis.get("language", "en"),
+        "customer_id": analysis.get("customer_id", ""),
+        "status": "failed",
+        "timestamp": job.get("created_at"),
+        "attachments": message.get("attachments", []),
+        "thread_key": job.get("thread_key"),
+        "trace": {"trace_id": job.get("trace_id"), "spans": job.get("trace_spans", [])},
+    }
 
 def get_email_details(email_id):
     """Get detailed information about a specific email."""
     try:
-        from bson.objectid import ObjectId
         try:
             # Try to convert the email_id to ObjectId
             email = emails_collection.find_one({"_id": ObjectId(email_id)})
@@ -779,15 +3679,48 @@ def get_email_details(email_id):
             # If conversion fails, try to find by string ID (just in case)
             email = emails_collection.find_one({"_id": email_id})
         
+        archived = False
+        if not email:
+            email = emails_archive_collection.find_one({"_id": ObjectId(email_id)}) if ObjectId.is_valid(email_id) else None
+            archived = email is not None
+        
+        dead_letter = None
+        if not email and ObjectId.is_valid(email_id):
+            job = jobs_collection.find_one({"email_id": ObjectId(email_id), "status": "dead"})
+            if job:
+                email = dead_letter_email(job)
+                dead_letter = {
+                    "stage": job.get("stage"),
+                    "attempts": job.get("attempts", 0),
+                    "last_error": job.get("last_error", ""),
+                    "dead_at": job['dead_at'].strftime("%Y-%m-%d %H:%M:%S") if job.get('dead_at') else '',
+                }
+        
         if not email:
             print(f"Email not found with ID: {email_id}")
             return None
             
-        # Get any associated responses
-        responses = responses_collection.find({
-            "recipient": email.get('sender'),
-            "subject": {"$regex": re.escape(email.get('subject', '')), "$options": "i"}
-        }).sort("timestamp", 1)
+        # Responses are linked by email_id; older ones only by recipient and reply subject
+        responses = list(responses_collection.find({"email_id": email['_id']}).sort("timestamp", 1))
+        if archived:
+            responses = list(responses_archive_collection.find({"email_id": email['_id']}).sort("timestamp", 1)) + responses
+        if not responses:
+            subject = email.get('subject', '')
+            responses = list(responses_collection.find({
+                "recipient": email.get('sender'),
+                "email_id": None,
+                "subject": {"$in": [subject, f"RE: {subject}"]}
+            }).sort("timestamp", 1))
+        
+        thread = []
+        if email.get('thread_key'):
+            thread = emails_collection.find(
+                {"thread_key": email['thread_key']},
+                {"subject": 1, "sender": 1, "timestamp": 1, "status": 1}
+            ).sort("timestamp", 1).limit(50)
+        
+        # Bodies and response texts are only loaded for the details view
+        hydrate_documents([email] + responses)
         
         # Format the email with responses
         email_details = {
@@ -805,6 +3738,19 @@ def get_email_details(email_id):
             "status": email.get('status', 'pending'),
             "timestamp": email.get('timestamp').strftime("%Y-%m-%d %H:%M:%S") if email.get('timestamp') else '',
             "response_time": email.get('response_time').strftime("%Y-%m-%d %H:%M:%S") if email.get('response_time') else '',
+            "attachments": email.get('attachments', []),
+            "trace": format_trace(email.get('trace')),
+            "thread_key": email.get('thread_key'),
+            "thread": [{
+                "id": str(message['_id']),
+                "subject": message.get('subject', ''),
+                "sender": message.get('sender', ''),
+                "status": message.get('status', 'pending'),
+                "timestamp": message['timestamp'].strftime("%Y-%m-%d %H:%M:%S") if message.get('timestamp') else '',
+                "current": message['_id'] == email['_id'],
+            } for message in thread],
+            "archived": archived,
+            "dead_letter": dead_letter,
             "responses": []
         }
         
@@ -820,12 +3766,23 @@ def get_email_details(email_id):
         print(f"Email Details Error: {str(e)}")
         return None
 
-@app.route('/')
+@bp.route('/')
 def dashboard():
     email_log = get_emails_by_category()
-    return render_template('dashboard.html', email_log=email_log, polling_active=polling_active)
+    try:
+        clusters = get_active_clusters()
+    except Exception as e:
+        print("Cluster Read Error:", e)
+        clusters = []
+    try:
+        dead_letters = get_dead_letters()
+    except Exception as e:
+        print("Dead Letter Read Error:", e)
+        dead_letters = []
+    return render_template('dashboard.html', email_log=email_log, clusters=clusters, dead_letters=dead_letters,
+                           polling_active=is_polling_active())
 
-@app.route('/analytics')
+@bp.route('/analytics')
 def analytics():
     weekly_report = generate_weekly_report()
     response_stats = get_response_statistics()
@@ -834,7 +3791,7 @@ def analytics():
                           report=weekly_report, 
                           response_stats=response_stats)
 
-@app.route('/view-email/<email_id>')
+@bp.route('/view-email/<email_id>')
 def view_email(email_id):
     try:
         email_details = get_email_details(email_id)
@@ -845,22 +3802,144 @@ def view_email(email_id):
         print(f"Error viewing email: {str(e)}")
         return f"Error loading email details: {str(e)}", 500
 
-@app.route('/api/weekly-report')
+@bp.route('/api/weekly-report')
 def api_weekly_report():
     return jsonify(generate_weekly_report())
 
-@app.route('/api/response-stats')
+@bp.route('/api/response-stats')
 def api_response_stats():
     return jsonify(get_response_statistics())
 
-@app.route('/api/email-details/<email_id>')
+def serialize_email_summary(email_doc):
+    """Add the display fields the dashboard's email cards need and make the summary JSON-safe."""
+    email_doc["time_ago"] = time_ago(email_doc["timestamp"])
+    email_doc["priority_color"] = priority_color(email_doc["priority"])
+    email_doc["timestamp"] = email_doc["timestamp"].strftime("%Y-%m-%d %H:%M:%S")
+    return email_doc
+
+@bp.route('/api/emails')
+def api_emails():
+    category = request.args.get('category', 'Unclassified')
+    cursor = request.args.get('cursor')
+    limit = min(request.args.get('limit', DASHBOARD_PAGE_SIZE, type=int), 100)
+    
+    try:
+        page = get_email_page(category, cursor, limit)
+    except Exception as e:
+        print("Email Page Error:", e)
+        return jsonify({"error": "Invalid page request"}), 400
+    
+    for email_doc in page["emails"]:
+        serialize_email_summary(email_doc)
+    return jsonify(page)
+
+@bp.route('/api/search')
+def api_search():
+    text = request.args.get('q', '').strip()
+    facets = {
+        "category": request.args.get('category'),
+        "status": request.args.get('status'),
+        "priority": request.args.get('priority'),
+        "date_from": request.args.get('from'),
+        "date_to": request.args.get('to'),
+    }
+    if not text and not any(facets.values()):
+        return jsonify({"error": "Missing search text or filter"}), 400
+    
+    try:
+        results = search_emails(
+            text,
+            page=max(request.args.get('page', 1, type=int), 1),
+            limit=min(request.args.get('limit', DASHBOARD_PAGE_SIZE, type=int), 100),
+            **facets
+        )
+    except ValueError as e:
+        return jsonify({"error": f"Invalid filter: {str(e)}"}), 400
+    except Exception as e:
+        print("Search Error:", e)
+        return jsonify({"error": "Search failed"}), 500
+    
+    for email_doc in results["results"]:
+        serialize_email_summary(email_doc)
+    return jsonify(results)
+
+@bp.route('/api/clusters')
+def api_clusters():
+    clusters = get_active_clusters(limit=min(request.args.get('limit', 10, type=int), 100))
+    for cluster in clusters:
+        cluster["first_seen"] = cluster["first_seen"].strftime("%Y-%m-%d %H:%M:%S")
+        cluster["last_seen"] = cluster["last_seen"].strftime("%Y-%m-%d %H:%M:%S")
+    return jsonify({"clusters": clusters})
+
+@bp.route('/api/queue-stats')
+def api_queue_stats():
+    return jsonify(get_queue_stats())
+
+@bp.route('/api/llm-stats')
+def api_llm_stats():
+    return jsonify(llm_gateway.stats())
+
+@bp.route('/api/cache-stats')
+def api_cache_stats():
+    return jsonify(llm_cache.stats())
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    """Expose the in-process metrics registry in the Prometheus text format."""
+    try:
+        queue_stats = get_queue_stats()
+        depth = {(QUEUE_STAGES[-1], "done"): queue_stats.pop("done")}
+        for status, stages in queue_stats.items():
+            depth.update({(stage, status): count for stage, count in stages.items()})
+        QUEUE_DEPTH.replace(depth)
+    except Exception as e:
+        print("Queue Metrics Error:", e)
+    
+    cache_stats = llm_cache.stats()
+    LLM_CACHE_HIT_RATIO.set(cache_stats["hit_rate"])
+    LLM_CACHE_LOOKUPS.set(cache_stats["hits"], result="hit")
+    LLM_CACHE_LOOKUPS.set(cache_stats["misses"], result="miss")
+    
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@bp.after_app_request
+def record_request_time(response):
+    if request.url_rule is not None and "request_started" in g:
+        HTTP_REQUEST_SECONDS.observe(time.monotonic() - g.request_started,
+                                     route=request.url_rule.rule, method=request.method)
+    return response
+
+@bp.route('/api/email-details/<email_id>')
 def api_email_details(email_id):
     details = get_email_details(email_id)
     if not details:
         return jsonify({"error": "Email not found"}), 404
     return jsonify(details)
 
-@app.route('/manual-response', methods=['POST'])
+@bp.route('/attachment/<email_id>/<part>')
+def download_attachment(email_id, part):
+    try:
+        email = emails_collection.find_one({"_id": ObjectId(email_id)})
+        if not email:
+            return "Email not found", 404
+        
+        result = fetch_attachment(email, part)
+        if not result:
+            return "Attachment not available", 404
+        
+        payload, attachment = result
+        filename = attachment.get('filename') or f"attachment-{part}"
+        return Response(payload, mimetype=attachment.get('content_type') or 'application/octet-stream',
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    except Exception as e:
+        print(f"Attachment Download Error: {str(e)}")
+        return f"Error downloading attachment: {str(e)}", 500
+
+@bp.route('/manual-response', methods=['POST'])
 def manual_response():
     try:
         data = request.json
@@ -868,22 +3947,25 @@ def manual_response():
         response_text = data.get('response')
         send_copy = data.get('send_copy', False)
         
-        from bson.objectid import ObjectId
+        restore_archived_email(ObjectId(email_id))
         email = emails_collection.find_one({"_id": ObjectId(email_id)})
         
         if not email:
             return jsonify({"success": False, "error": "Email not found"})
         
         # Update email status in database
-        emails_collection.update_one(
+        updated = emails_collection.find_one_and_update(
             {"_id": ObjectId(email_id)},
             {
                 "$set": {
                     "status": "resolved",
                     "response_time": datetime.now()
                 }
-            }
+            },
+            return_document=ReturnDocument.AFTER
         )
+        if updated:
+            record_rollup_change(email, updated)
         
         # Store response in database
         store_auto_response(
@@ -891,7 +3973,8 @@ def manual_response():
             f"RE: {email.get('subject')}",
             response_text,
             email.get('category'),
-            is_auto=False
+            is_auto=False,
+            email_id=email['_id']
         )
         
         # Send response email if requested
@@ -901,6 +3984,9 @@ def manual_response():
                 msg["Subject"] = f"RE: {email.get('subject')}"
                 msg["From"] = EMAIL_USER
                 msg["To"] = email.get('sender')
+                headers = reply_headers(email.get('message_id'), email.get('references', []))
+                for name, value in headers.items():
+                    msg[name] = value
                 
                 html_content = f"""
                 <!DOCTYPE html>
@@ -940,10 +4026,8 @@ def manual_response():
                 msg.attach(part1)
                 msg.attach(part2)
                 
-                with smtplib.SMTP("smtp.gmail.com", 587) as server:
-                    server.starttls()
-                    server.login(EMAIL_USER, EMAIL_PASS)
-                    server.send_message(msg)
+                smtp_pool.send_message(msg)
+                record_conversation_reply(email.get('thread_key'), headers["Message-ID"], email.get('subject', ''))
             except Exception as e:
                 print(f"Error sending response email: {str(e)}")
         
@@ -951,36 +4035,98 @@ def manual_response():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
-@app.route('/change-status', methods=['POST'])
+VALID_STATUSES = ['pending', 'in-progress', 'resolved', 'closed']
+BULK_UPDATE_MAX = 500  # emails per bulk status/category request
+
+def update_email_status(email_ids, new_status):
+    """Set the status of several emails through the bulk writer and move their rollup counts."""
+    update_data = {
+        "status": new_status
+    }
+    
+    if new_status == 'resolved':
+        update_data["response_time"] = datetime.now()
+    
+    previous = list(emails_collection.find({"_id": {"$in": email_ids}}, ROLLUP_FIELDS))
+    bulk_writer.write(emails_collection, [UpdateOne({"_id": email["_id"]}, {"$set": update_data}) for email in previous],
+                      timeout=BULK_WRITE_TIMEOUT)
+    record_rollup_changes([(email, {**email, **update_data}) for email in previous])
+    return len(previous)
+
+def reassign_emails(email_ids, new_category):
+    """Move several emails to a category, forwarding each one its new department has not seen yet.
+
+    Returns the number of emails updated and the ids of those that could not be
+    forwarded; their forwarded_to is left unchanged.
+    """
+    emails = hydrate_documents(list(emails_collection.find({"_id": {"$in": email_ids}})))
+    to_email = DEPARTMENTS.get(new_category)
+    
+    updates, forward_failures = [], []
+    for email in emails:
+        update_data = {
+            "category": new_category,
+            "category_source": "manual"
+        }
+        
+        # Forward to new department if needed
+        if to_email and to_email != email.get('forwarded_to'):
+            if forward_email(
+                email.get('subject', ''), 
+                email.get('body', ''), 
+                to_email, 
+                email.get('sender', ''),
+                analysis_from_document(email, new_category)
+            ):
+                update_data["forwarded_to"] = to_email
+            else:
+                forward_failures.append(str(email["_id"]))
+        updates.append(UpdateOne({"_id": email["_id"]}, {"$set": update_data}))
+    
+    bulk_writer.write(emails_collection, updates, timeout=BULK_WRITE_TIMEOUT)
+    record_rollup_changes([(email, {**email, "category": new_category}) for email in emails])
+    return len(emails), forward_failures
+
+def bulk_email_ids(data):
+    email_ids = data.get('email_ids') or []
+    if not isinstance(email_ids, list) or not email_ids:
+        raise ValueError("No emails selected")
+    if len(email_ids) > BULK_UPDATE_MAX:
+        raise ValueError(f"At most {BULK_UPDATE_MAX} emails can be updated at once")
+    return [ObjectId(email_id) for email_id in email_ids]
+
+@bp.route('/change-status', methods=['POST'])
 def change_status():
     try:
         data = request.json
         email_id = data.get('email_id')
         new_status = data.get('status')
         
-        valid_statuses = ['pending', 'in-progress', 'resolved', 'closed']
-        if new_status not in valid_statuses:
+        if new_status not in VALID_STATUSES:
             return jsonify({"success": False, "error": "Invalid status value"})
         
-        from bson.objectid import ObjectId
-        
-        update_data = {
-            "status": new_status
-        }
-        
-        if new_status == 'resolved':
-            update_data["response_time"] = datetime.now()
+        restore_archived_email(ObjectId(email_id))
+        if not update_email_status([ObjectId(email_id)], new_status):
+            return jsonify({"success": False, "error": "Email not found"})
+        return jsonify({"success": True})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@bp.route('/bulk-change-status', methods=['POST'])
+def bulk_change_status():
+    try:
+        data = request.json
+        new_status = data.get('status')
         
-        emails_collection.update_one(
-            {"_id": ObjectId(email_id)},
-            {"$set": update_data}
-        )
+        if new_status not in VALID_STATUSES:
+            return jsonify({"success": False, "error": "Invalid status value"})
         
-        return jsonify({"success": True})
+        updated = update_email_status(bulk_email_ids(data), new_status)
+        return jsonify({"success": True, "updated": updated})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
-@app.route('/reassign-category', methods=['POST'])
+@bp.route('/reassign-category', methods=['POST'])
 def reassign_category():
     try:
         data = request.json
@@ -991,58 +4137,43 @@ def reassign_category():
         if new_category not in valid_categories:
             return jsonify({"success": False, "error": "Invalid category"})
         
-        from bson.objectid import ObjectId
-        
-        # Get the email first
-        email = emails_collection.find_one({"_id": ObjectId(email_id)})
-        if not email:
+        restore_archived_email(ObjectId(email_id))
+        updated, forward_failures = reassign_emails([ObjectId(email_id)], new_category)
+        if not updated:
             return jsonify({"success": False, "error": "Email not found"})
         
-        # Update the category
-        emails_collection.update_one(
-            {"_id": ObjectId(email_id)},
-            {"$set": {
-                "category": new_category
-            }}
-        )
+        return jsonify({"success": True, "forward_failed": bool(forward_failures)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@bp.route('/bulk-reassign-category', methods=['POST'])
+def bulk_reassign_category():
+    try:
+        data = request.json
+        new_category = data.get('category')
         
-        # Forward to new department if needed
-        to_email = DEPARTMENTS.get(new_category)
-        if to_email and to_email != email.get('forwarded_to'):
-            # Forward to new department
-            try:
-                forward_email(
-                    email.get('subject', ''), 
-                    email.get('body', ''), 
-                    to_email, 
-                    email.get('sender', '')
-                )
-                
-                # Update forwarded_to field
-                emails_collection.update_one(
-                    {"_id": ObjectId(email_id)},
-                    {"$set": {"forwarded_to": to_email}}
-                )
-            except Exception as e:
-                print(f"Error forwarding to new department: {str(e)}")
+        valid_categories = list(DEPARTMENTS.keys()) + ["Unclassified"]
+        if new_category not in valid_categories:
+            return jsonify({"success": False, "error": "Invalid category"})
         
-        return jsonify({"success": True})
+        updated, forward_failures = reassign_emails(bulk_email_ids(data), new_category)
+        return jsonify({"success": True, "updated": updated, "forward_failed": forward_failures})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
-@app.route('/generate-response', methods=['POST'])
+@bp.route('/generate-response', methods=['POST'])
 def generate_ai_response():
     try:
         data = request.json
         email_id = data.get('email_id')
         
-        from bson.objectid import ObjectId
-        email = emails_collection.find_one({"_id": ObjectId(email_id)})
+        query = {"_id": ObjectId(email_id)}
+        email = hydrate_document(emails_collection.find_one(query) or emails_archive_collection.find_one(query))
         
         if not email:
             return jsonify({"success": False, "error": "Email not found"})
             
-        body = email.get('body', '')
+        body = email.get('normalized_body') or normalize_body(email.get('body', ''))
         category = email.get('category', 'General Inquiry')
         sentiment = email.get('sentiment', 'Neutral')
         
@@ -1058,25 +4189,35 @@ def generate_ai_response():
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
-@app.route('/toggle-polling', methods=['POST'])
+@bp.route('/retry-job', methods=['POST'])
+def retry_job():
+    try:
+        email_id = request.json.get('email_id')
+        if not requeue_dead_jobs(ObjectId(email_id)):
+            return jsonify({"success": False, "error": "No failed job for this email"})
+        return jsonify({"success": True})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)})
+
+@bp.route('/toggle-polling', methods=['POST'])
 def toggle_polling():
     try:
-        global polling_active
         data = request.json
-        polling_active = data.get('active', False)
-        print(f"Email polling set to: {polling_active}")
-        return jsonify({"success": True, "active": polling_active})
+        active = bool(data.get('active', False))
+        set_polling_active(active)
+        print(f"Email polling set to: {active}")
+        return jsonify({"success": True, "active": active})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
-@app.template_filter('format_datetime')
+@bp.app_template_filter('format_datetime')
 def format_datetime(value, format='%Y-%m-%d %H:%M'):
     """Format a datetime object to string."""
     if isinstance(value, datetime):
         return value.strftime(format)
     return value
 
-@app.template_filter('time_ago')
+@bp.app_template_filter('time_ago')
 def time_ago(dt):
     """Format a datetime as time ago string."""
     if not isinstance(dt, datetime):
@@ -1100,7 +4241,7 @@ def time_ago(dt):
     else:
         return dt.strftime("%Y-%m-%d")
 
-@app.template_filter('priority_color')
+@bp.app_template_filter('priority_color')
 def priority_color(priority):
     """Get color for priority level."""
     colors = {
@@ -1112,7 +4253,7 @@ def priority_color(priority):
     }
     return colors.get(priority, "#fbbc05")
 
-@app.template_filter('sentiment_color')
+@bp.app_template_filter('sentiment_color')
 def sentiment_color(sentiment):
     """Get color for sentiment level."""
     colors = {
@@ -1123,9 +4264,18 @@ def sentiment_color(sentiment):
     }
     return colors.get(sentiment, "#fbbc05")
 
+def create_app():
+    """Build the Flask application; this opens no connections and starts no threads."""
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    return app
+
+app = create_app()
+
 if __name__ == '__main__':
     templates_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
     os.makedirs(templates_dir, exist_ok=True)
     
+    start_background_processing()
     port = int(5000)
     app.run(host="0.0.0.0", port=port)
@@ -0,0 +1,20 @@
+# Production server settings: gunicorn app:app
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count() * 2 + 1)))
+threads = int(os.getenv("WEB_THREADS", "4"))
+timeout = 120
+accesslog = "-"
+
+# Importing app.py opens no connections, so the app can be loaded once before forking
+preload_app = True
+
+def post_worker_init(worker):
+    # The MongoDB poller lease elects one worker to read the mailbox and, with the default
+    # QUEUE_WORKERS_ON=leader, to run the queue jobs; the others only take over if it goes away.
+    # Set RUN_POLLER_IN_WEB=false to serve only the dashboard and run `flask --app app run-poller` separately.
+    if os.getenv("RUN_POLLER_IN_WEB", "true").lower() == "true":
+        from app import start_background_processing
+        start_background_processing()
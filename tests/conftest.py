@@ -0,0 +1,17 @@
+import mongomock
+import pytest
+
+import app
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """Point every collection the app uses at an in-memory mongomock database."""
+    database = mongomock.MongoClient().email_management
+    monkeypatch.setattr(app, "db", database)
+    for name in ("emails", "responses", "metrics", "jobs", "settings", "locks", "conversations", "clusters"):
+        monkeypatch.setattr(app, f"{name}_collection", database[name])
+    monkeypatch.setattr(app, "blobs_collection", database.email_bodies)
+    monkeypatch.setattr(app, "emails_archive_collection", database.emails_archive)
+    monkeypatch.setattr(app, "responses_archive_collection", database.responses_archive)
+    return database
@@ -0,0 +1,66 @@
+import json
+import time
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Replace the Gemini gateway with a stub that records prompts and answers with a fixed analysis."""
+    prompts = []
+
+    class Gateway:
+        def generate(self, prompt, name, generation_config=None):
+            prompts.append(prompt)
+            return json.dumps({"category": "Technical", "sentiment": "Neutral", "customer_id": "XK42QZ",
+                               "draft_reply": "Thanks for reaching out."})
+
+    monkeypatch.setattr(app, "llm_gateway", Gateway())
+    monkeypatch.setattr(app, "llm_cache", app.LLMCache(128, 3600))
+    return prompts
+
+
+def test_customer_id_requests_respect_hourly_budget(gemini, monkeypatch):
+    monkeypatch.setattr(app, "CUSTOMER_ID_LLM_BUDGET", 1)
+    monkeypatch.setattr(app, "customer_id_llm_budget", {"window_start": time.time(), "used": 0})
+
+    first = app.analyze_email("Login problem", "I cannot log in, my acct is XK-42QZ please help")
+    second = app.analyze_email("Login problem again", "Still cannot log in, acct XK-42QZ, please help me")
+
+    assert '"customer_id"' in gemini[0] and first["customer_id"] == "XK42QZ"
+    assert '"customer_id"' not in gemini[1] and second["customer_id"] is None
+
+
+def test_known_customer_id_pattern_skips_the_model_field(gemini, monkeypatch):
+    monkeypatch.setattr(app, "customer_id_llm_budget", {"window_start": time.time(), "used": 0})
+
+    analysis = app.analyze_email("Billing", "Please check customer ID CUS12345 for a double charge")
+
+    assert analysis["customer_id"] == "CUS12345"
+    assert '"customer_id"' not in gemini[0]
+    assert app.customer_id_llm_budget["used"] == 0
+
+
+def test_customer_id_in_a_stripped_signature_is_found_locally(gemini, mongo, monkeypatch):
+    monkeypatch.setattr(app, "DUPLICATE_DETECTION", False)
+    monkeypatch.setattr(app, "customer_id_llm_budget", {"window_start": time.time(), "used": 0})
+    body = "My invoice was charged twice this month.\n-- \nJohn\nCustomer ID: CUS12345"
+    job = {"message": {"subject": "Double charge", "body": body, "message_id": "<a@example.com>", "references": []}}
+
+    result = app.analyze_job(job)
+
+    assert "CUS12345" not in gemini[0]
+    assert result["analysis"]["customer_id"] == "CUS12345"
+    assert '"customer_id"' not in gemini[0] and app.customer_id_llm_budget["used"] == 0
+
+
+def test_model_sees_id_lines_stripped_from_the_prompt_text(gemini, monkeypatch):
+    monkeypatch.setattr(app, "customer_id_llm_budget", {"window_start": time.time(), "used": 0})
+    body = "I cannot log in since yesterday.\n-- \nJohn\nmy acct is XK-42QZ"
+
+    analysis = app.analyze_email("Login problem", app.normalize_body(body), raw_body=body)
+
+    assert '"customer_id"' in gemini[0] and "my acct is XK-42QZ" in gemini[0]
+    assert analysis["customer_id"] == "XK42QZ" and app.customer_id_llm_budget["used"] == 1
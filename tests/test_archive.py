@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+
+import app
+
+
+class ApplyingWriter:
+    """Applies bulk writer operations one at a time, which mongomock supports."""
+
+    def write(self, collection, ops, timeout=None):
+        for op in ops:
+            collection.update_one(op._filter, op._doc, upsert=bool(op._upsert))
+
+
+def test_status_change_restores_an_archived_email(mongo, monkeypatch):
+    monkeypatch.setattr(app, "bulk_writer", ApplyingWriter())
+    email_id = ObjectId()
+    old = datetime.now() - timedelta(days=app.ARCHIVE_AFTER_DAYS + 1)
+    mongo.emails_archive.insert_one({"_id": email_id, "subject": "Old", "category": "Billing", "status": "pending",
+                                     "timestamp": old})
+    mongo.responses_archive.insert_one({"email_id": email_id, "response_text": "Thanks", "timestamp": old})
+
+    response = app.app.test_client().post("/change-status", json={"email_id": str(email_id), "status": "resolved"})
+
+    assert response.get_json() == {"success": True}
+    assert mongo.emails.find_one({"_id": email_id})["status"] == "resolved"
+    assert mongo.emails_archive.count_documents({}) == 0
+    assert mongo.responses.count_documents({"email_id": email_id}) == 1
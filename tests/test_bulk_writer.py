@@ -0,0 +1,60 @@
+import time
+from concurrent.futures import Future
+
+from pymongo import InsertOne
+from pymongo.errors import OperationFailure
+from pymongo.write_concern import WriteConcern
+
+import app
+
+
+def test_partial_batch_is_flushed_after_interval(mongo):
+    writer = app.BulkWriter(batch_size=3, interval=0.05, write_concern=WriteConcern(w=1))
+    started = time.monotonic()
+
+    writer.write(mongo.emails, [InsertOne({"_id": 1})], timeout=2)
+
+    assert time.monotonic() - started < 1
+    assert mongo.emails.count_documents({}) == 1
+    writer.close()
+
+
+def test_failed_flush_fails_futures_and_keeps_writer_running(mongo, monkeypatch):
+    writer = app.BulkWriter(batch_size=10, interval=0.01, write_concern=WriteConcern(w=1))
+    monkeypatch.setattr(app, "db", {})  # db[name] raises KeyError
+    future = writer.submit(mongo.emails, InsertOne({"_id": 1}))
+    assert isinstance(future.exception(timeout=2), KeyError)
+
+    monkeypatch.setattr(app, "db", mongo)
+    writer.write(mongo.emails, [InsertOne({"_id": 2}), InsertOne({"_id": 3})], timeout=2)
+    assert mongo.emails.count_documents({}) == 2
+    writer.close()
+
+
+class FailingBlobWriter:
+    """Completes operations as soon as they are submitted; body blobs fail."""
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, collection, operation):
+        self.submitted.append(collection.name)
+        future = Future()
+        if collection.name == "email_bodies":
+            future.set_exception(OperationFailure("disk full"))
+        else:
+            collection.insert_one(operation._doc)
+            future.set_result(True)
+        return future
+
+
+def test_email_is_rolled_back_when_its_body_cannot_be_stored(mongo, monkeypatch):
+    writer = FailingBlobWriter()
+    monkeypatch.setattr(app, "bulk_writer", writer)
+    analysis = {"summary": "", "sentiment": "Neutral", "priority": 3, "language": "en", "customer_id": None}
+
+    stored = app.store_email("Billing", "a@example.com", "Refund", "Please refund my order. " * 40, analysis=analysis)
+
+    assert not stored
+    assert writer.submitted == ["emails", "email_bodies"]
+    assert mongo.emails.count_documents({}) == 0
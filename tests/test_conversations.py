@@ -0,0 +1,27 @@
+from bson.objectid import ObjectId
+
+import app
+
+
+def inbound(message_id, uid, in_reply_to=None):
+    return {"message_id": message_id, "in_reply_to": in_reply_to, "references": [], "uid": uid, "uidvalidity": 1,
+            "subject": "Cannot log in", "sender": "customer@example.com", "body": "I cannot log in",
+            "attachments": []}
+
+
+def test_reply_to_auto_acknowledgement_joins_the_original_thread(mongo, monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, "send_auto_response", lambda to, text, subject, headers=None: sent.append(headers) or True)
+    monkeypatch.setattr(app, "store_email", lambda *args, **kwargs: True)
+    first = inbound("<first@example.com>", 1)
+    job = {"message": first, "email_id": ObjectId(), "thread_key": app.resolve_thread_key(first), "to_email": None,
+           "reply_stored": True, "analysis": {"category": "Technical", "priority": 2, "auto_response": "We are on it."}}
+
+    app.reply_job(job)
+    app.store_job(job)
+    answer = inbound("<second@example.com>", 2, in_reply_to=sent[0]["Message-ID"])
+
+    assert app.resolve_thread_key(answer) == job["thread_key"]
+    conversation = mongo.conversations.find_one({"_id": job["thread_key"]})
+    assert set(conversation["message_ids"]) == {"<first@example.com>", sent[0]["Message-ID"]}
+    assert conversation["subject"] == "Cannot log in"
@@ -0,0 +1,114 @@
+import uuid
+
+import pytest
+from bson.objectid import ObjectId
+
+import app
+
+COMPLAINT = (
+    "Hello, I ordered a blender on March 3rd with order number {order} and it still has not been delivered. "
+    "The tracking page has shown in transit for two weeks and nobody answers the phone when I call the "
+    "support line. I want a refund or a replacement shipped immediately, and I expect a reply within two "
+    "business days. Regards, {name}"
+)
+
+
+def complaint(name, order):
+    return f"Order {order} never arrived " + COMPLAINT.format(name=name, order=order)
+
+
+def distance(a, b):
+    return bin(app.simhash(a) ^ app.simhash(b)).count("1")
+
+
+@pytest.mark.parametrize("name, order", [
+    ("Alice Smith", "A1000"),
+    ("Bob Jones", "A1000"),
+    ("Alice Smith", "B77310"),
+    ("Carla Diaz", "C48213"),
+    ("Eve Müller-Lüdenscheidt", "X1"),
+])
+def test_templated_complaints_stay_within_duplicate_distance(name, order):
+    assert distance(complaint("Alice Smith", "A1000"), complaint(name, order)) <= app.DUPLICATE_MAX_DISTANCE
+
+
+def test_different_emails_are_not_duplicates():
+    other = ("I was charged twice for my subscription this month, please refund the duplicate payment to my "
+             "card. My account email is the same as this one and I have attached the statement showing both "
+             "charges. Thanks for sorting this quickly.")
+    assert distance(complaint("Alice Smith", "A1000"), other) > app.DUPLICATE_MAX_DISTANCE
+
+
+def make_job(mongo, name, order):
+    body = complaint(name, order)
+    job = {
+        "_id": ObjectId(),
+        "email_id": ObjectId(),
+        "stage": "fetched",
+        "lease_token": uuid.uuid4().hex,
+        "attempts": 0,
+        "message": {
+            "uid": 1, "uidvalidity": 1, "message_id": f"<{uuid.uuid4().hex}@example.com>",
+            "subject": f"Order {order} never arrived", "sender": f"{name}@example.com",
+            "body": body, "normalized_body": body,
+        },
+    }
+    mongo.jobs.insert_one(job)
+    return job
+
+
+def retry(mongo, job):
+    """The job as a worker leases it again after the stage failed."""
+    return mongo.jobs.find_one({"_id": job["_id"]})
+
+
+@pytest.fixture
+def analyses(monkeypatch):
+    calls = []
+
+    def analyze_email(subject, body, raise_errors=False, raw_body=None):
+        calls.append(subject)
+        return {"category": "Complaint", "sentiment": "Negative", "summary": "", "customer_id": None,
+                "auto_response": "Sorry about that.", "classified_by": "gemini", "language": "en", "priority": 4}
+
+    monkeypatch.setattr(app, "analyze_email", analyze_email)
+    monkeypatch.setattr(app, "duplicate_index", app.NearDuplicateIndex(app.DUPLICATE_MAX_DISTANCE, app.DUPLICATE_WINDOW_HOURS))
+    return calls
+
+
+def test_retried_founder_is_still_forwarded(mongo, analyses):
+    job = make_job(mongo, "Alice Smith", "A1000")
+    app.analyze_job(job)  # the stage fails after the cluster was created
+
+    result = app.analyze_job(retry(mongo, job))
+
+    assert result["cluster_member"] is False
+    assert len(analyses) == 1
+    assert mongo.clusters.find_one({"_id": result["cluster_id"]})["count"] == 1
+
+
+def test_near_duplicate_joins_cluster_once(mongo, analyses):
+    founder = app.analyze_job(make_job(mongo, "Alice Smith", "A1000"))
+    job = make_job(mongo, "Bob Jones", "B77310")
+
+    first = app.analyze_job(job)
+    second = app.analyze_job(retry(mongo, job))
+
+    assert first["cluster_id"] == second["cluster_id"] == founder["cluster_id"]
+    assert first["cluster_member"] and second["cluster_member"]
+    assert second["cluster_count"] == 2
+    assert mongo.clusters.find_one({"_id": founder["cluster_id"]})["count"] == 2
+    assert len(analyses) == 1
+
+
+def test_concurrent_founders_end_up_in_one_cluster(mongo, analyses, monkeypatch):
+    # Both workers look up the index before either has created its cluster
+    monkeypatch.setattr(app.duplicate_index, "find", lambda fingerprint: None)
+
+    first = app.analyze_job(make_job(mongo, "Alice Smith", "A1000"))
+    second = app.analyze_job(make_job(mongo, "Bob Jones", "B77310"))
+
+    assert first["cluster_member"] is False
+    assert second["cluster_member"] is True and second["cluster_id"] == first["cluster_id"]
+    assert mongo.clusters.count_documents({}) == 1
+    assert mongo.clusters.find_one({"_id": first["cluster_id"]})["count"] == 2
@@ -0,0 +1,82 @@
+import json
+import random
+
+import pytest
+
+import app
+
+TOPICS = {
+    "Billing": "invoice charged refund payment card subscription billed twice amount statement",
+    "Technical": "login error crash password app reset server bug page loading",
+    "Complaint": "terrible rude disappointed service manager awful waited unacceptable complaint staff",
+}
+FILLER = "please thanks hello regards team today help would like know could"
+
+
+def samples(count, seed=1):
+    rng = random.Random(seed)
+    result = []
+    for i in range(count):
+        label = list(TOPICS)[i % len(TOPICS)]
+        words = rng.sample(TOPICS[label].split(), 4) + rng.sample(FILLER.split(), 6)
+        # Some emails mention another topic too, so the held-out accuracy is not perfect
+        words += rng.sample(TOPICS[rng.choice(list(TOPICS))].split(), 2)
+        rng.shuffle(words)
+        result.append((" ".join(words), label, 1))
+    return result
+
+
+@pytest.fixture
+def classifier(tmp_path):
+    path = tmp_path / "model.json"
+    path.write_text(json.dumps({"models": {"category": app.LocalClassifier.train_model(samples(900))}}))
+    return app.LocalClassifier(str(path))
+
+
+def test_confidence_is_calibrated_and_monotonic(classifier):
+    classifier.reload_if_changed()
+    calibration = classifier.models["category"]["calibration"]
+
+    assert calibration == sorted(calibration)
+    assert all(0 <= value <= 1 for value in calibration)
+
+
+def test_unfamiliar_text_is_not_confident(classifier):
+    assert classifier.confident_label("category", "The weather in Lisbon was lovely and we visited museums") is None
+    assert classifier.confident_label("category", "lorem ipsum dolor sit amet consectetur adipiscing elit") is None
+
+
+def test_held_out_accuracy_backs_the_threshold(classifier):
+    test_set = samples(300, seed=2)
+    confident = [(classifier.predict("category", text), label) for text, label, _ in test_set
+                 if classifier.confident_label("category", text)]
+    correct = sum(predicted == label for (predicted, _), label in confident)
+
+    assert confident
+    assert correct / len(confident) >= app.LOCAL_CLASSIFIER_THRESHOLD - 0.05
+
+
+def test_uncalibrated_model_is_never_confident(tmp_path):
+    model = app.LocalClassifier.fit(samples(300), 20000)
+    path = tmp_path / "model.json"
+    path.write_text(json.dumps({"models": {"category": model}}))
+
+    classifier = app.LocalClassifier(str(path))
+
+    assert classifier.predict("category", "invoice refund charged twice payment")[1] == 0
+
+
+def test_training_ignores_labels_from_the_classifier_and_clusters(mongo, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "LOCAL_CLASSIFIER_PATH", str(tmp_path / "model.json"))
+    text = "I was charged twice for my subscription"
+    mongo.emails.insert_many([
+        {"subject": "a", "body": text, "category": "Billing", "sentiment": "Negative", "classified_by": "gemini"},
+        {"subject": "b", "body": text, "category": "Billing", "sentiment": "Negative"},
+        {"subject": "c", "body": text, "category": "Billing", "sentiment": "Negative", "classified_by": "local"},
+        {"subject": "d", "body": text, "category": "Billing", "sentiment": "Negative", "classified_by": "cluster"},
+        {"subject": "e", "body": text, "category": "Billing", "sentiment": "Neutral", "classified_by": "fallback"},
+        {"subject": "f", "body": text, "category": "Technical", "sentiment": "Negative", "classified_by": "local",
+         "category_source": "manual"},
+    ])
+
+    assert app.train_local_classifier() == (3, 2)
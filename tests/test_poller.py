@@ -0,0 +1,50 @@
+import threading
+
+import pytest
+from pymongo.errors import AutoReconnect
+
+import app
+
+
+class StopPoller(BaseException):
+    pass
+
+
+@pytest.fixture
+def fast_poller(monkeypatch):
+    monkeypatch.setattr(app, "POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(app, "IMAP_MAX_BACKOFF", 0.01)
+    monkeypatch.setattr(app, "poller_lease_state", {"held_until": float("-inf")})
+
+
+def test_poller_survives_mongo_errors_while_renewing_lease(monkeypatch, fast_poller):
+    outcomes = [AutoReconnect("primary stepped down"), AutoReconnect("connection reset"), False, StopPoller()]
+
+    def acquire_poller_lease():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(app, "acquire_poller_lease", acquire_poller_lease)
+    monkeypatch.setattr(threading, "excepthook", lambda args: None)
+    poller = threading.Thread(target=app.fetch_and_process_emails, daemon=True)
+    poller.start()
+    poller.join(timeout=5)
+
+    assert outcomes == []
+
+
+def test_only_the_lease_holder_runs_queue_jobs(mongo, monkeypatch, fast_poller):
+    monkeypatch.setattr(app, "QUEUE_WORKERS_ON", "leader")
+
+    assert app.acquire_poller_lease()
+    assert app.runs_queue_jobs()
+
+    # Another process cannot take the lease while it is held
+    monkeypatch.setattr(app, "poller_owner", lambda: "other-host:1")
+    assert not app.acquire_poller_lease()
+    assert not app.runs_queue_jobs()
+
+    monkeypatch.setattr(app, "QUEUE_WORKERS_ON", "all")
+    assert app.runs_queue_jobs()
@@ -0,0 +1,62 @@
+import time
+import uuid
+
+from bson.objectid import ObjectId
+
+import app
+
+
+def test_finished_job_drops_message_body_and_trace(mongo):
+    job = {
+        "_id": "1:42", "email_id": ObjectId(), "stage": "replied", "status": "ready",
+        "lease_token": uuid.uuid4().hex, "trace_spans": [{"name": "fetch"}],
+        "message": {"uid": 42, "subject": "Hi", "sender": "a@example.com", "body": "long body", "normalized_body": "long body"},
+    }
+    mongo.jobs.insert_one(job)
+    mongo.emails.insert_one({"_id": job["email_id"]})
+
+    app.complete_stage(job, {}, [{"name": "store"}])
+
+    stored = mongo.jobs.find_one({"_id": "1:42"})
+    assert stored["status"] == "done" and stored["completed_at"]
+    assert "body" not in stored["message"] and "normalized_body" not in stored["message"]
+    assert "trace_spans" not in stored
+    assert mongo.emails.find_one({"_id": job["email_id"]})["trace"]["spans"] == [{"name": "fetch"}, {"name": "store"}]
+
+
+def test_worker_that_lost_its_lease_does_not_complete_the_stage(mongo):
+    job = {"_id": "1:43", "email_id": ObjectId(), "stage": "replied", "status": "ready", "lease_token": "stale",
+           "message": {"uid": 43, "body": "long body"}}
+    mongo.jobs.insert_one({**job, "lease_token": "new-owner"})
+    mongo.emails.insert_one({"_id": job["email_id"]})
+
+    assert not app.complete_stage(job, {}, [{"name": "store"}])
+
+    stored = mongo.jobs.find_one({"_id": "1:43"})
+    assert stored["stage"] == "replied" and stored["message"]["body"] == "long body"
+    assert "trace" not in mongo.emails.find_one({"_id": job["email_id"]})
+
+
+def test_lease_is_renewed_while_a_stage_runs(mongo, monkeypatch):
+    monkeypatch.setattr(app, "JOB_LEASE_SECONDS", 0.3)
+    job = {"_id": "1:44", "stage": "fetched", "lease_token": uuid.uuid4().hex, "lease_until": None}
+    mongo.jobs.insert_one(dict(job))
+
+    with app.lease_heartbeat(job):
+        time.sleep(0.25)
+
+    assert mongo.jobs.find_one({"_id": "1:44"})["lease_until"] is not None
+
+
+def test_dead_lettered_email_is_listed_and_retryable(mongo):
+    email_id = ObjectId()
+    mongo.jobs.insert_one({"_id": "1:45", "email_id": email_id, "stage": "analyzed", "status": "dead", "attempts": 6,
+                           "last_error": "analyzed: could not forward", "dead_at": app.datetime.now(),
+                           "message": {"uid": 45, "subject": "Refund", "sender": "a@example.com", "body": "Refund please"}})
+
+    assert [job["email_id"] for job in app.get_dead_letters()] == [str(email_id)]
+    details = app.get_email_details(str(email_id))
+    assert details["body"] == "Refund please" and details["dead_letter"]["stage"] == "analyzed"
+
+    assert app.requeue_dead_jobs(email_id) == 1
+    assert mongo.jobs.find_one({"_id": "1:45"})["status"] == "ready"
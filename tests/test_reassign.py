@@ -0,0 +1,25 @@
+import app
+
+
+class RecordingWriter:
+    def __init__(self):
+        self.ops = []
+
+    def write(self, collection, ops, timeout=None):
+        self.ops.extend(ops)
+
+
+def test_failed_forward_keeps_previous_department_and_is_reported(mongo, monkeypatch):
+    writer = RecordingWriter()
+    monkeypatch.setattr(app, "bulk_writer", writer)
+    monkeypatch.setattr(app, "record_rollup_changes", lambda changes: None)
+    monkeypatch.setattr(app, "forward_email", lambda *args, **kwargs: False)
+    monkeypatch.setitem(app.DEPARTMENTS, "Technical", "tech@example.com")
+    monkeypatch.setitem(app.DEPARTMENTS, "Billing", "billing@example.com")
+    email_id = mongo.emails.insert_one({"subject": "Refund", "body": "Please refund my order", "sender": "a@example.com",
+                                        "category": "Technical", "forwarded_to": "tech@example.com"}).inserted_id
+
+    updated, forward_failures = app.reassign_emails([email_id], "Billing")
+
+    assert updated == 1 and forward_failures == [str(email_id)]
+    assert writer.ops[0]._doc == {"$set": {"category": "Billing", "category_source": "manual"}}